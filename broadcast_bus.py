@@ -0,0 +1,117 @@
+# broadcast_bus.py
+"""
+Cross-process delivery for WebSocket broadcasts.
+
+broadcast() publishes to a bus instead of straight to local sockets:
+
+* LocalBus (default) - single process, delivers directly.
+* MongoBus           - every event is also written to the capped
+                       'ws_events' collection; each worker tails it and
+                       delivers events published by other workers to its
+                       own sockets. Works on a standalone mongod (no
+                       replica set / change streams needed).
+
+Select with BROADCAST_BUS=local|mongo.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+from pymongo import CursorType
+
+logger = logging.getLogger("broadcast_bus")
+
+BROADCAST_BUS = os.environ.get("BROADCAST_BUS", "local").lower()
+# Events waiting for the writer thread before publishes start being dropped
+PUBLISH_BACKLOG = int(os.environ.get("BROADCAST_PUBLISH_BACKLOG", "10000"))
+
+
+class LocalBus:
+    """Deliver in-process only."""
+
+    def __init__(self, deliver):
+        # deliver(target, key, payload) -> None, called on the event loop
+        self.deliver = deliver
+
+    def start(self, loop):
+        pass
+
+    def publish(self, target: str, key: str | None, payload):
+        self.deliver(target, key, payload)
+
+
+class MongoBus(LocalBus):
+    """Deliver locally, and relay through a tailed capped collection."""
+
+    def __init__(self, deliver, collection):
+        super().__init__(deliver)
+        self.collection = collection
+        self.origin = uuid.uuid4().hex
+        self.loop = None
+        self._outbox = queue.Queue(maxsize=PUBLISH_BACKLOG)
+
+    def start(self, loop):
+        self.loop = loop
+        threading.Thread(target=self._tail, name="broadcast-bus", daemon=True).start()
+        threading.Thread(target=self._write, name="broadcast-bus-writer", daemon=True).start()
+
+    def publish(self, target: str, key: str | None, payload):
+        self.deliver(target, key, payload)
+        event = {"origin": self.origin, "target": target, "key": key, "payload": payload}
+        # Keep the blocking write off the event loop. One writer thread
+        # inserts in publish order, which is the order other workers relay.
+        try:
+            self._outbox.put_nowait(event)
+        except queue.Full:
+            logger.error("Broadcast bus publish backlog full; event not relayed")
+
+    def _write(self):
+        while True:
+            event = self._outbox.get()
+            try:
+                self.collection.insert_one(event)
+            except Exception as e:
+                logger.error(f"Broadcast bus publish failed: {e}")
+
+    def _tail(self):
+        # Only relay events published after this worker started
+        last = self.collection.find_one(sort=[("$natural", -1)])
+        last_id = last["_id"] if last else None
+
+        while True:
+            try:
+                # ObjectIds minted by different workers are not ordered, so
+                # resume by position instead: read the collection in insertion
+                # ($natural) order and skip through the last event seen
+                skipping = last_id is not None
+                cursor = self.collection.find({}, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    for event in cursor:
+                        if skipping:
+                            skipping = event["_id"] != last_id
+                            continue
+                        last_id = event["_id"]
+                        if event.get("origin") == self.origin:
+                            continue
+                        self.loop.call_soon_threadsafe(
+                            self.deliver, event["target"], event.get("key"), event["payload"]
+                        )
+                    if skipping:
+                        # Read to the end without meeting it: the capped
+                        # collection wrapped past our position
+                        logger.warning("Broadcast bus fell behind ws_events; some events were not relayed")
+                        skipping = False
+            except Exception as e:
+                logger.error(f"Broadcast bus tail error: {e}")
+            # Cursor died (empty collection or error): re-open shortly
+            time.sleep(1)
+
+
+def create_bus(deliver):
+    if BROADCAST_BUS == "mongo":
+        from database import ws_events
+        return MongoBus(deliver, ws_events)
+    return LocalBus(deliver)
@@ -0,0 +1,86 @@
+# customer_cache.py
+"""
+In-process cache of resolved customers for ensure_customer().
+
+Ingest resolves the same few senders over and over; a hit returns the
+customer without touching MongoDB. Entries are keyed by email and by
+phone, expire after a TTL and are evicted least-recently-used beyond
+MAX_ENTRIES. Code that changes a cached field (name, ...) calls
+discard(tb1_id); changes made by other processes show up once the entry
+expires. Fields other workers change often (last_read_at, tags) are not
+cached at all; ingest reads those from the conversation row.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+MAX_ENTRIES = int(os.environ.get("CUSTOMER_CACHE_SIZE", "10000"))
+TTL_SECONDS = float(os.environ.get("CUSTOMER_CACHE_TTL", "60"))
+
+# What ingest needs from a customer doc (see main._message_doc and
+# database.conversation_update); the cache holds nothing else
+CACHED_FIELDS = ("tb1_id", "conversation_id", "name", "cust_email", "phone")
+
+
+class CustomerCache:
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (customer fields, expires_at monotonic)
+        self._keys = {}                 # tb1_id -> keys pointing at it
+
+    @staticmethod
+    def _key_set(doc):
+        keys = set()
+        if doc.get("cust_email"):
+            keys.add(("email", doc["cust_email"]))
+        if doc.get("phone"):
+            keys.add(("phone", doc["phone"]))
+        return keys
+
+    def get(self, email=None, phone=None) -> dict | None:
+        """Cached customer fields for 'email' (else 'phone'), or None."""
+        key = ("email", email) if email else ("phone", phone)
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is None:
+                return None
+            fields, expires_at = hit
+            if time.monotonic() >= expires_at:
+                self._drop(fields["tb1_id"])
+                return None
+            self._entries.move_to_end(key)
+            return dict(fields)
+
+    def put(self, doc: dict):
+        """Remember a customer doc just read from or written to the database."""
+        if not doc or "tb1_id" not in doc:
+            return
+        fields = {f: doc[f] for f in CACHED_FIELDS if f in doc}
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            self._drop(fields["tb1_id"])
+            keys = self._key_set(fields)
+            for key in keys:
+                self._entries[key] = (fields, expires_at)
+            self._keys[fields["tb1_id"]] = keys
+            while len(self._entries) > self.max_entries:
+                _, (old, _) = self._entries.popitem(last=False)
+                self._drop(old["tb1_id"])
+
+    def discard(self, tb1_id):
+        """Forget a customer whose cached fields changed."""
+        with self._lock:
+            self._drop(tb1_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def _drop(self, tb1_id):
+        # Called with self._lock held
+        for key in self._keys.pop(tb1_id, ()):
+            self._entries.pop(key, None)
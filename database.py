@@ -1,10 +1,20 @@
 # database.py
 from pymongo import MongoClient, ReturnDocument
 from gridfs import GridFS
-from pymongo.errors import DuplicateKeyError
-from datetime import datetime, timezone
+from gridfs.errors import FileExists
+from pymongo.errors import DuplicateKeyError, CollectionInvalid, BulkWriteError
+from datetime import datetime, timezone, timedelta
+import hashlib
+import logging
 import os
+import threading
 import uuid
+from urllib.parse import quote
+from bson import ObjectId
+from search_index import query_tokens, terms_filter, exact_hits, customer_terms, MIN_TERM_LENGTH
+from customer_cache import CustomerCache
+
+logger = logging.getLogger("database")
 
 MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017")
 DB_NAME = os.environ.get("MONGO_DB", "mini_crisp_db")
@@ -12,6 +22,7 @@ DB_NAME = os.environ.get("MONGO_DB", "mini_crisp_db")
 client = MongoClient(MONGO_URI, tz_aware=True)
 db = client[DB_NAME]
 fs = GridFS(db)
+CUSTOMER_CACHE = CustomerCache()
 
 # -----------------------------
 # Collections
@@ -25,6 +36,19 @@ email_accounts = db.email_accounts
 whatsapp_accounts = db["whatsapp_accounts"]
 social_accounts = db["social_accounts"]
 ai_history = db["ai_history"] # Store AI interactions
+conversations = db["conversations"]         # one inbox summary row per customer
+fs_files = db["fs.files"]                   # GridFS file docs (sha256 + refcount for dedup)
+fs_chunks = db["fs.chunks"]
+
+# Capped log tailed by every worker for cross-process WebSocket broadcasts
+if "ws_events" not in db.list_collection_names():
+    try:
+        db.create_collection("ws_events", capped=True, size=16 * 1024 * 1024)
+    except CollectionInvalid:
+        pass  # Another worker created it first
+ws_events = db["ws_events"]
+leases = db["leases"]                       # leader election (one doc per lease name)
+imap_state = db["imap_state"]               # per account/folder UIDVALIDITY + last UID
 # auto-increment counters
 
 # -----------------------------
@@ -44,17 +68,31 @@ email_received.create_index("tb1_id")
 email_received.create_index("timestamp")
 email_received.create_index("message_id", unique=True, sparse=True)
 email_received.create_index([("tb1_id", 1), ("timestamp", -1)]) # Composite for faster conversation list
+email_received.create_index("search_terms") # Prefix search (see search_index.py)
+email_received.create_index([("email", 1), ("timestamp", -1)]) # Thread view (/api/sync)
+email_received.create_index("attachments.file_id", sparse=True) # Download name/type (see attachment_url)
+email_received.create_index("attachments.id", sparse=True)
+customers.create_index("search_terms")
 threads.create_index("visitor_email", unique=True)
 whatsapp_accounts.create_index("phone_number_id", unique=True)
 social_accounts.create_index("account_id", unique=True)
 ai_history.create_index("timestamp", expireAfterSeconds=60*60*24*30) # Keep history for 30 days
+conversations.create_index("tb1_id", unique=True)
+conversations.create_index("conversation_id")
+conversations.create_index([("timestamp", -1), ("tb1_id", -1)]) # Inbox list order
+conversations.create_index([("accounts", 1), ("timestamp", -1)])
+conversations.create_index("seq") # Admin socket resume
+conversations.create_index("unread", partialFilterExpression={"unread": {"$gt": 0}}) # Inbox unread totals
+imap_state.create_index([("account", 1), ("folder", 1)], unique=True)
+fs_files.create_index("sha256", unique=True, sparse=True) # Content-addressed attachments
+fs_files.create_index([("preview_of", 1), ("preview_size", 1)], unique=True, sparse=True) # Cached previews
 
 
 # -----------------------------
 # Auto-increment helper
 # -----------------------------
 def get_next_sequence(name: str) -> int:
-    """Auto-increment counter for tb1_id."""
+    """Next value of an auto-increment counter (strictly ordered, one round trip per id)."""
     doc = counters.find_one_and_update(
         {"_id": name},
         {"$inc": {"seq": 1}},
@@ -63,6 +101,66 @@ def get_next_sequence(name: str) -> int:
     )
     return int(doc["seq"])
 
+# tb1_ids are reserved from the counter this many at a time and handed out
+# locally. Unused ids of a block are skipped when the process exits: tb1_id
+# is unique, not gapless.
+TB1_ID_BLOCK = int(os.environ.get("TB1_ID_BLOCK", "100"))
+
+class SequenceBlocks:
+    """Ids reserved from a counter but not yet handed out, per counter name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = {}   # name -> [next id, last id]
+
+    def take(self, name: str) -> int | None:
+        with self._lock:
+            block = self._blocks.get(name)
+            if not block or block[0] > block[1]:
+                return None
+            block[0] += 1
+            return block[0] - 1
+
+    def install(self, name: str, last: int, size: int) -> int:
+        """Adopt the block ending at 'last' and return its first id."""
+        with self._lock:
+            self._blocks[name] = [last - size + 2, last]
+        return last - size + 1
+
+    def drop(self, name: str):
+        with self._lock:
+            self._blocks.pop(name, None)
+
+SEQUENCE_BLOCKS = SequenceBlocks()
+
+def allocate_id(name: str, block: int = TB1_ID_BLOCK) -> int:
+    """get_next_sequence() that only goes to the database once per block."""
+    value = SEQUENCE_BLOCKS.take(name)
+    if value is None:
+        doc = counters.find_one_and_update(
+            {"_id": name},
+            {"$inc": {"seq": block}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        value = SEQUENCE_BLOCKS.install(name, int(doc["seq"]), block)
+    return value
+
+def is_tb1_id_clash(error: DuplicateKeyError) -> bool:
+    """Whether an insert collided on tb1_id rather than on email/phone."""
+    details = error.details or {}
+    return "tb1_id" in (details.get("keyPattern") or {}) or "tb1_id_1" in details.get("errmsg", "")
+
+def resync_tb1_id():
+    """
+    Move the tb1_id counter past the highest stored id (e.g. after a
+    restore or a manual import) and drop the local block that clashed.
+    """
+    SEQUENCE_BLOCKS.drop("tb1_id")
+    top = customers.find_one({}, {"tb1_id": 1}, sort=[("tb1_id", -1)])
+    if top:
+        counters.update_one({"_id": "tb1_id"}, {"$max": {"seq": top["tb1_id"]}}, upsert=True)
+
 # -----------------------------
 # Customer helpers
 # -----------------------------
@@ -70,79 +168,144 @@ def ensure_customer(email: str | None = None, name: str | None = None, phone: st
     """
     Return customer doc.
     If not exists -> create.
-    Always ensures last_seen & last_read_at fields exist.
     Can identify by email OR phone.
+    Repeat senders are answered from CUSTOMER_CACHE without a round trip
+    (so last_seen lags by at most its TTL); otherwise one
+    find_one_and_update resolves the customer and refreshes last_seen.
     """
     if not email and not phone:
         raise ValueError("email or phone required")
 
     email = email.strip().lower() if email else None
-    now = datetime.now(timezone.utc)
+    cached = CUSTOMER_CACHE.get(email, phone)
+    if cached and (cached.get("name") or not name):
+        return cached
 
-    # Try finding by email
-    doc = None
-    if email:
-        doc = customers.find_one({"cust_email": email})
-    
-    # Try finding by phone if email search failed or was not provided
-    if not doc and phone:
-        doc = customers.find_one({"phone": phone})
-
-    if doc:
-        # 🔄 Update last_seen
-        if refresh_last_seen:
-            customers.update_one(
-                {"_id": doc["_id"]},
-                {"$set": {"last_seen": now}}
+    now = datetime.now(timezone.utc)
+    touch = customer_touch(now, refresh_last_seen, name)
+    doc = customers.find_one_and_update(customer_filter(email, phone), touch, return_document=ReturnDocument.AFTER)
+    if not doc and email and phone:
+        # Known by phone only
+        doc = customers.find_one_and_update({"phone": phone}, touch, return_document=ReturnDocument.AFTER)
+
+    if not doc:
+        doc = _create_customer(now, email, phone, name)
+
+    CUSTOMER_CACHE.put(doc)
+    return doc
+
+def _create_customer(now: datetime, email: str | None, phone: str | None, name: str | None) -> dict:
+    """🆕 Upsert a new customer; a concurrent creator's doc wins."""
+    for _ in range(3):
+        new_doc = new_customer_doc(allocate_id("tb1_id"), now, email=email, phone=phone, name=name)
+        try:
+            return customers.find_one_and_update(
+                customer_filter(email, phone),
+                {"$setOnInsert": new_doc},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
             )
-
+        except DuplicateKeyError as e:
+            if is_tb1_id_clash(e):
+                resync_tb1_id()
+                continue
+            # Lost the race, or the phone already belongs to another customer
+            doc = customers.find_one(customer_filter(email, phone))
+            if not doc and phone:
+                doc = customers.find_one({"phone": phone})
+            return doc
+    raise RuntimeError("Could not allocate a free tb1_id")
+
+def customer_filter(email: str | None, phone: str | None) -> dict:
+    """Which customer ensure_customer() means: by email first, else phone."""
+    return {"cust_email": email} if email else {"phone": phone}
+
+def customer_touch(now: datetime, refresh_last_seen: bool = True, name: str | None = None) -> list:
+    """
+    Pipeline update for a returning customer: bumps last_seen and fills in
+    fields older customer docs lack. A customer first seen without a name
+    gets 'name', and its search terms with it.
+    """
+    fields = {
         # 🧩 Backward compatibility (older customers)
-        if "last_read_at" not in doc:
-            customers.update_one(
-                {"_id": doc["_id"]},
-                {"$set": {"last_read_at": None}}
-            )
-            doc["last_read_at"] = None
-
-        if "conversation_id" not in doc:
-             new_conv_id = str(uuid.uuid4())
-             customers.update_one(
-                 {"_id": doc["_id"]},
-                 {"$set": {"conversation_id": new_conv_id}}
-             )
-             doc["conversation_id"] = new_conv_id
-
-        doc["last_seen"] = now
-        return doc
-
-    # 🆕 Create new customer
-    tb1_id = get_next_sequence("tb1_id")
-    customer_data = {
+        "last_read_at": {"$ifNull": ["$last_read_at", None]},
+        "conversation_id": {"$ifNull": ["$conversation_id", str(uuid.uuid4())]}
+    }
+    if refresh_last_seen:
+        fields["last_seen"] = now
+    if name:
+        unnamed = {"$in": [{"$ifNull": ["$name", ""]}, ["", None]]}
+        name_terms = customer_terms({"name": name})
+        fields["name"] = {"$cond": [unnamed, {"$literal": name}, "$name"]}
+        fields["search_terms"] = {"$cond": [
+            unnamed,
+            {"$setUnion": [{"$ifNull": ["$search_terms", []]}, {"$literal": name_terms}]},
+            {"$ifNull": ["$search_terms", []]}
+        ]}
+    return [{"$set": fields}]
+
+def new_customer_doc(tb1_id: int, now: datetime, email: str | None = None, phone: str | None = None, name: str | None = None) -> dict:
+    """The document inserted for a customer seen for the first time."""
+    doc = {
         "tb1_id": tb1_id,
         "name": name or "",
         "created_at": now,
         "last_seen": now,
-        "created_at": now,
-        "last_seen": now,
         "last_read_at": None,
         "conversation_id": str(uuid.uuid4()) # Persistent Conversation ID
     }
     if email:
-        customer_data["cust_email"] = email
+        doc["cust_email"] = email
     if phone:
-        customer_data["phone"] = phone
+        doc["phone"] = phone
+    doc["search_terms"] = customer_terms(doc)
+    return doc
 
-    try:
-        customers.insert_one(customer_data)
-        return customer_data
-    except DuplicateKeyError:
-        # In case of race condition, try fetching again
-        if email:
-            return customers.find_one({"cust_email": email})
-        if phone:
-            return customers.find_one({"phone": phone})
-    
-    return customers.find_one({"tb1_id": tb1_id})
+def ensure_customers(emails: list) -> dict:
+    """
+    Bulk ensure_customer() for email addresses: one lookup for the whole
+    set, one insert_many for the new ones. Returns {email: customer doc}.
+    """
+    emails = list(dict.fromkeys(e.strip().lower() for e in emails if e))
+    cached = {e: c for e in emails if (c := CUSTOMER_CACHE.get(e))}
+    emails = [e for e in emails if e not in cached]
+    if not emails:
+        return cached
+    now = datetime.now(timezone.utc)
+
+    found = {d["cust_email"]: d for d in customers.find({"cust_email": {"$in": emails}})}
+    if found:
+        customers.update_many({"cust_email": {"$in": list(found)}}, {"$set": {"last_seen": now}})
+    for doc in found.values():
+        doc["last_seen"] = now
+        # 🧩 Backward compatibility (older customers)
+        if "last_read_at" not in doc or "conversation_id" not in doc:
+            found[doc["cust_email"]] = ensure_customer(email=doc["cust_email"])
+
+    new_docs = []
+    for email in emails:
+        if email in found:
+            continue
+        new_docs.append(new_customer_doc(allocate_id("tb1_id"), now, email=email))
+
+    if new_docs:
+        try:
+            customers.insert_many(new_docs, ordered=False)
+            found.update((d["cust_email"], d) for d in new_docs)
+        except BulkWriteError as e:
+            # Lost a race for some addresses: take whatever is stored now
+            failed = {new_docs[err["index"]]["cust_email"] for err in e.details.get("writeErrors", [])}
+            found.update((d["cust_email"], d) for d in new_docs if d["cust_email"] not in failed)
+            for doc in customers.find({"cust_email": {"$in": list(failed)}}):
+                found[doc["cust_email"]] = doc
+            # Not stored by anyone: those collided on tb1_id
+            if failed - found.keys():
+                resync_tb1_id()
+                for email in failed - found.keys():
+                    found[email] = ensure_customer(email=email)
+    for doc in found.values():
+        CUSTOMER_CACHE.put(doc)
+    return {**cached, **found}
 
 def get_whatsapp_accounts():
     """List all configured WhatsApp business accounts."""
@@ -186,20 +349,78 @@ def get_customer_by_email(email: str) -> dict | None:
         return None
     return customers.find_one({"cust_email": email.strip().lower()})
 
-def search_customers(query: str) -> list:
-    """Fuzzy search for customers by name, email, or phone."""
-    if not query:
+def search_customers(query: str, limit: int = 5) -> list:
+    """Prefix search for customers by name, email, or phone, best match first."""
+    tokens = query_tokens(query)
+    if not tokens:
+        return []
+    pipeline = [
+        {"$match": terms_filter(tokens)},
+        {"$addFields": {"_score": exact_hits(tokens)}},
+        {"$sort": {"_score": -1, "last_seen": -1}},
+        {"$limit": limit},
+        {"$project": {"_score": 0, "search_terms": 0}}
+    ]
+    return list(customers.aggregate(pipeline))
+
+def search_conversation_ids(query: str, filters: dict | None = None, limit: int = 1000) -> list:
+    """
+    tb1_ids whose messages match every query token (as a word prefix), the
+    'limit' most recently active first -- the inbox lists them by time.
+    A query of one-letter tokens only matches customers instead (see
+    conversation_search_tokens).
+    """
+    tokens, on_messages = conversation_search_tokens(query)
+    if not tokens:
         return []
-    # Simple regex search across relevant fields
-    regex = {"$regex": query, "$options": "i"}
-    curr = customers.find({
-        "$or": [
-            {"name": regex},
-            {"cust_email": regex},
-            {"phone": regex}
-        ]
-    }).limit(5)
-    return list(curr)
+    if on_messages:
+        pipeline = conversation_search_pipeline(tokens, filters, limit)
+    else:
+        ids = [c["tb1_id"] for c in customers.find(terms_filter(tokens), {"tb1_id": 1}).sort("last_seen", -1).limit(limit)]
+        if not filters or not ids:
+            return ids
+        pipeline = conversation_ids_pipeline({**filters, "tb1_id": {"$in": ids}}, limit)
+    return [g["_id"] for g in email_received.aggregate(pipeline, allowDiskUse=True)]
+
+def conversation_search_tokens(query: str) -> tuple[list, bool]:
+    """
+    (tokens, on_messages) for search_conversation_ids(). A one-letter prefix
+    matches nearly every message term, so such tokens are dropped; a query
+    made only of them searches customer names, emails and phones instead.
+    """
+    tokens = query_tokens(query)
+    long_tokens = [t for t in tokens if len(t) >= MIN_TERM_LENGTH]
+    return (long_tokens, True) if long_tokens else (tokens, False)
+
+def conversation_search_pipeline(tokens: list, filters: dict | None, limit: int) -> list:
+    """email_received aggregation behind search_conversation_ids()."""
+    return conversation_ids_pipeline({**(filters or {}), **terms_filter(tokens)}, limit)
+
+def conversation_ids_pipeline(match: dict, limit: int) -> list:
+    """
+    email_received aggregation: tb1_ids with a message matching 'match',
+    the 'limit' whose latest such message is newest first.
+    """
+    return [
+        {"$match": match},
+        {"$group": {"_id": "$tb1_id", "last": {"$max": "$timestamp"}}},
+        {"$sort": {"last": -1}},
+        {"$limit": limit}
+    ]
+
+def search_messages(query: str, filters: dict | None = None, limit: int = 10) -> list:
+    """Messages matching every query token, most exact hits first, then newest."""
+    tokens = query_tokens(query)
+    if not tokens:
+        return []
+    pipeline = [
+        {"$match": {**(filters or {}), **terms_filter(tokens)}},
+        {"$addFields": {"_score": exact_hits(tokens)}},
+        {"$sort": {"_score": -1, "timestamp": -1}},
+        {"$limit": limit},
+        {"$project": {"_score": 0, "search_terms": 0}}
+    ]
+    return list(email_received.aggregate(pipeline))
 
 def get_all_messages_for_customer(email: str) -> list:
     """Fetch all messages (received and sent) for a specific customer."""
@@ -256,35 +477,50 @@ def add_email_account(data):
         "created_at": datetime.now(timezone.utc)
     })
 
-def mark_customer_read(email: str):
-    """Mark conversation as read by admin."""
+def mark_customer_read(email: str) -> dict | None:
+    """Mark conversation as read by admin. Returns the updated conversation row."""
     if not email:
-        return
+        return None
 
-    customers.update_one(
-        {"cust_email": email.strip().lower()},
-        {"$set": {"last_read_at": datetime.now(timezone.utc)}}
+    email = email.strip().lower()
+    now = datetime.now(timezone.utc)
+    # Dashboard identifier is the email, or the phone for WhatsApp visitors
+    cust = customers.find_one_and_update(
+        {"$or": [{"cust_email": email}, {"phone": email}]},
+        {"$set": {"last_read_at": now}},
+        projection={"tb1_id": 1}
+    )
+    if not cust:
+        return None
+    # The row keeps its own copy: ingest counts unread messages against it
+    unread = {"tb1_id": cust["tb1_id"], "unread": {"$gt": 0}}
+    if not conversations.find_one(unread, {"_id": 1}):
+        conversations.update_one({"tb1_id": cust["tb1_id"]}, {"$set": {"last_read_at": now}})
+        return None  # Already read: no new seq, nothing to push
+    return conversations.find_one_and_update(
+        unread,
+        {"$set": {"unread": 0, "last_read_at": now, "updated_at": now, "seq": next_inbox_seq()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
 
 def get_unread_count(tb1_id: int) -> int:
     """
-    Count unread visitor messages for a customer.
+    Unread visitor messages for a customer: the counter kept on their
+    conversation row (incremented on ingest, reset by mark_customer_read).
     """
-    customer = customers.find_one({"tb1_id": tb1_id})
-    if not customer:
-        return 0
-
-    last_read = customer.get("last_read_at")
-
-    query = {
-        "tb1_id": tb1_id,
-        "sender": "visitor"
-    }
-
-    if last_read:
-        query["timestamp"] = {"$gt": last_read}
-
-    return email_received.count_documents(query)
+    conv = conversations.find_one({"tb1_id": tb1_id}, {"unread": 1})
+    return int(conv.get("unread", 0)) if conv else 0
+
+def get_unread_totals() -> dict:
+    """Unread messages and conversations across the whole inbox, in one aggregation."""
+    totals = list(conversations.aggregate([
+        {"$match": {"unread": {"$gt": 0}}},
+        {"$group": {"_id": None, "messages": {"$sum": "$unread"}, "conversations": {"$sum": 1}}}
+    ]))
+    if not totals:
+        return {"messages": 0, "conversations": 0}
+    return {"messages": totals[0]["messages"], "conversations": totals[0]["conversations"]}
 
 # -----------------------------
 # User/Auth Model (NEW)
@@ -330,15 +566,301 @@ def get_notes(email: str):
 
 def add_tag(email: str, tag: str):
     if not email or not tag: return
-    customers.update_one(
+    cust = customers.find_one_and_update(
         {"cust_email": email.strip().lower()},
-        {"$addToSet": {"tags": tag.strip()}}
+        {"$addToSet": {"tags": tag.strip()}},
+        projection={"tb1_id": 1, "tags": 1},
+        return_document=ReturnDocument.AFTER
     )
+    if cust:
+        return set_conversation_tags(cust["tb1_id"], cust.get("tags", []))
 
 def get_tags(email: str):
     cust = customers.find_one({"cust_email": email.strip().lower()})
     return cust.get("tags", []) if cust else []
 
+# -----------------------------
+# Leases (leader election across workers)
+# -----------------------------
+def try_acquire_lease(name: str, holder: str, ttl_seconds: int, info: dict | None = None) -> bool:
+    """
+    Take or renew the lease 'name' for 'holder'. Succeeds if the lease is
+    free, expired, or already ours; otherwise the upsert collides on _id.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        leases.update_one(
+            {"_id": name, "$or": [{"holder": holder}, {"expires_at": {"$lt": now}}]},
+            [{"$set": {
+                "acquired_at": {"$cond": [{"$eq": ["$holder", holder]}, "$acquired_at", now]},
+                "holder": holder,
+                "expires_at": now + timedelta(seconds=ttl_seconds),
+                "renewed_at": now,
+                **{k: {"$literal": v} for k, v in (info or {}).items()}
+            }}],
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+def release_lease(name: str, holder: str):
+    """Give the lease up early so another worker can take over at once."""
+    leases.update_one(
+        {"_id": name, "holder": holder},
+        {"$set": {"expires_at": datetime.now(timezone.utc)}}
+    )
+
+def get_lease(name: str) -> dict | None:
+    return leases.find_one({"_id": name})
+
+def request_lease_task(name: str, task: str):
+    """Ask whichever worker holds lease 'name' to run 'task' (see take_lease_task)."""
+    leases.update_one({"_id": name}, {"$addToSet": {"tasks": task}})
+
+def take_lease_task(name: str, task: str) -> bool:
+    """Claim a pending request for 'task' on lease 'name'; True if there was one."""
+    return leases.update_one({"_id": name, "tasks": task}, {"$pull": {"tasks": task}}).modified_count > 0
+
+# -----------------------------
+# Attachments (content-addressed GridFS)
+# -----------------------------
+def attachment_url(file_id, filename: str | None = None) -> str:
+    """
+    Download URL for one message's attachment entry. A stored file is shared
+    by every message with the same bytes, so the name (matched against the
+    entry on download) tells which entry's filename and type to serve.
+    """
+    url = f"/api/attachments/{file_id}"
+    return f"{url}?name={quote(filename, safe='')}" if filename else url
+
+def store_attachment(content: bytes, filename: str, content_type: str | None = None, metadata: dict | None = None) -> ObjectId:
+    """
+    Store attachment bytes once per distinct content (SHA-256) and return
+    the GridFS file id. Storing bytes that already exist only bumps the
+    file's refcount.
+    """
+    sha = hashlib.sha256(content).hexdigest()
+    existing = fs_files.find_one_and_update({"sha256": sha}, {"$inc": {"refcount": 1}}, projection={"_id": 1})
+    if existing:
+        return existing["_id"]
+
+    file_id = ObjectId()
+    try:
+        fs.put(
+            content, _id=file_id, filename=filename, content_type=content_type,
+            metadata=metadata or {}, sha256=sha, refcount=1
+        )
+        return file_id
+    except FileExists:
+        # Same bytes stored concurrently (GridFS reports the sha256 index
+        # clash as FileExists): drop our orphaned chunks, share theirs
+        fs_chunks.delete_many({"files_id": file_id})
+        return fs_files.find_one_and_update({"sha256": sha}, {"$inc": {"refcount": 1}}, projection={"_id": 1})["_id"]
+
+def release_attachments(attachments: list):
+    """Drop one reference to each stored attachment; delete unreferenced files."""
+    for att in attachments or []:
+        raw_id = att.get("file_id") or att.get("id")
+        if not raw_id or not ObjectId.is_valid(raw_id):
+            continue
+        doc = fs_files.find_one_and_update(
+            {"_id": ObjectId(raw_id), "refcount": {"$gt": 0}},
+            {"$inc": {"refcount": -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        # Conditional delete: a concurrent store_attachment may have re-referenced it
+        if doc and doc["refcount"] <= 0 and fs_files.delete_one({"_id": doc["_id"], "refcount": {"$lte": 0}}).deleted_count:
+            fs_chunks.delete_many({"files_id": doc["_id"]})
+            # Its thumbnails/previews (see previews.py) go with it
+            for preview in fs_files.find({"preview_of": doc["_id"]}, {"_id": 1}):
+                fs.delete(preview["_id"])
+
+# -----------------------------
+# IMAP sync state (incremental UID fetch)
+# -----------------------------
+MAX_UID_RETRIES = int(os.environ.get("IMAP_MAX_UID_RETRIES", "5"))
+
+def get_folder_state(account: str, folder: str) -> dict | None:
+    return imap_state.find_one({"account": account.lower(), "folder": folder})
+
+def save_folder_state(account: str, folder: str, uidvalidity: int | None, last_uid: int, highestmodseq: int | None = None, failed_uid: int | None = None):
+    """
+    Remember how far 'folder' has been read; a new UIDVALIDITY resets it.
+    'failed_uid' is the UID the sync stopped at (last_uid is just before
+    it). Failures at the same UID are counted, and after
+    IMAP_MAX_UID_RETRIES the UID is skipped so one bad message cannot
+    stall the folder for good.
+    """
+    key = {"account": account.lower(), "folder": folder}
+    attempts = 0
+    if failed_uid is not None:
+        prev = imap_state.find_one(key, {"failed_uid": 1, "failed_attempts": 1}) or {}
+        attempts = prev.get("failed_attempts", 0) + 1 if prev.get("failed_uid") == failed_uid else 1
+        if attempts >= MAX_UID_RETRIES:
+            logger.error(f"[{account}/{folder}] Giving up on UID {failed_uid} after {attempts} failed attempts")
+            last_uid, failed_uid, attempts = failed_uid, None, 0
+    imap_state.update_one(
+        key,
+        {"$set": {
+            "uidvalidity": uidvalidity,
+            "last_uid": last_uid,
+            "highestmodseq": highestmodseq,
+            "failed_uid": failed_uid,
+            "failed_attempts": attempts,
+            "synced_at": datetime.now(timezone.utc)
+        }},
+        upsert=True
+    )
+
+# -----------------------------
+# Conversation summaries (admin inbox list)
+# -----------------------------
+# A seq is taken before its row is written, so rows can become visible out
+# of seq order: a reader may see seq N+1 while N is still in flight. Resume
+# rereads this many seqs below the client's position to cover such writers.
+# Batch writers reserve at most INBOX_SEQ_RESERVE_MAX seqs at a time, so the
+# slack covers several of them in flight at once.
+INBOX_SEQ_RESERVE_MAX = 20
+INBOX_SEQ_SLACK = max(int(os.environ.get("INBOX_SEQ_SLACK", "100")), 5 * INBOX_SEQ_RESERVE_MAX)
+
+def next_inbox_seq() -> int:
+    """Monotonic number stamped on every conversation row change."""
+    return get_next_sequence("inbox_seq")
+
+def reserve_inbox_seqs(count: int):
+    """
+    Yield 'count' inbox seqs for a batch write, reserving them in blocks of
+    at most INBOX_SEQ_RESERVE_MAX as they are used, so no more than one
+    block is ever taken but not yet written (see INBOX_SEQ_SLACK).
+    """
+    while count > 0:
+        block = min(count, INBOX_SEQ_RESERVE_MAX)
+        doc = counters.find_one_and_update(
+            {"_id": "inbox_seq"},
+            {"$inc": {"seq": block}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        top = int(doc["seq"])
+        yield from range(top - block + 1, top + 1)
+        count -= block
+
+def current_inbox_seq() -> int:
+    doc = counters.find_one({"_id": "inbox_seq"})
+    return int(doc["seq"]) if doc else 0
+
+def conversation_changes_since(seq: int, limit: int) -> list:
+    """
+    Conversation rows changed after 'seq', oldest change first. Includes
+    the last INBOX_SEQ_SLACK seqs before it, which the caller may already
+    hold (rows are full snapshots, so repeats are harmless).
+    """
+    since = max(seq - INBOX_SEQ_SLACK, 0)
+    return list(conversations.find({"seq": {"$gt": since}}, {"_id": 0}).sort("seq", 1).limit(limit))
+
+def record_conversation_message(cust: dict, doc: dict, preview: str = "") -> dict:
+    """
+    Fold a newly stored message into the customer's conversation row and
+    return the updated row. Latest-message fields only move forward in time,
+    so backfilling older mail never overwrites the preview of a newer one.
+    """
+    return record_conversation_messages(cust, [(doc, preview)])
+
+def record_conversation_messages(cust: dict, items: list, seq: int | None = None) -> dict:
+    """
+    record_conversation_message() for several (doc, preview) pairs of one
+    customer in a single update. 'seq' comes from reserve_inbox_seqs() when
+    the caller updates many rows at once.
+    """
+    return conversations.find_one_and_update(
+        {"tb1_id": cust["tb1_id"]},
+        conversation_update(cust, items, seq or next_inbox_seq()),
+        upsert=True,
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+def conversation_update(cust: dict, items: list, seq: int) -> list:
+    """Pipeline update folding (doc, preview) pairs into a conversation row."""
+    def ts_of(item):
+        ts = item[0]["timestamp"]
+        return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts
+
+    doc, preview = max(items, key=ts_of)
+    ts = ts_of((doc, preview))
+
+    # Read on the row itself, so a mark-read on another worker is never
+    # missed; rows from before it was kept there fall back to the customer's
+    last_read = {"$ifNull": ["$last_read_at", {"$literal": cust.get("last_read_at")}]}
+    unread = [
+        {"$cond": [{"$gt": [ts_of(item), last_read]}, 1, 0]}
+        for item in items if item[0].get("sender") == "visitor"
+    ]
+    sources = sorted({d.get("source") for d, _ in items if d.get("source")})
+    accounts = sorted({(d.get("account_email") or "").lower() for d, _ in items} - {""})
+    has_attachments = any(d.get("attachments") for d, _ in items)
+
+    is_latest = {"$gte": [ts, {"$ifNull": ["$timestamp", ts]}]}
+
+    def latest(field, value):
+        return {"$cond": [is_latest, {"$literal": value}, f"${field}"]}
+
+    return [{"$set": {
+        "tb1_id": cust["tb1_id"],
+        "conversation_id": cust.get("conversation_id"),
+        "email": {"$literal": doc.get("email")},
+        "name": {"$literal": cust.get("name") or doc.get("email")},
+        "tags": {"$ifNull": ["$tags", {"$literal": cust.get("tags", [])}]},
+        "last_message": latest("last_message", preview),
+        "attachments": latest("attachments", doc.get("attachments") or []),
+        "source": latest("source", doc.get("source")),
+        "account_email": latest("account_email", doc.get("account_email")),
+        "last_message_id": latest("last_message_id", doc.get("message_id")),
+        "status": latest("status", doc.get("status")),
+        "timestamp": {"$max": ["$timestamp", ts]},
+        "sources": {"$setUnion": [{"$ifNull": ["$sources", []]}, {"$literal": sources}]},
+        "accounts": {"$setUnion": [{"$ifNull": ["$accounts", []]}, {"$literal": accounts}]},
+        "has_attachments": {"$or": [{"$ifNull": ["$has_attachments", False]}, has_attachments]},
+        "unread": {"$add": [{"$ifNull": ["$unread", 0]}, *unread]},
+        "last_read_at": last_read,
+        "updated_at": datetime.now(timezone.utc),
+        "seq": seq
+    }}]
+
+def set_conversation_tags(tb1_id: int, tags: list) -> dict | None:
+    """Mirror a customer's tags onto their conversation row."""
+    return conversations.find_one_and_update(
+        {"tb1_id": tb1_id},
+        {"$set": {"tags": tags, "updated_at": datetime.now(timezone.utc), "seq": next_inbox_seq()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+def set_message_status(message_id: str, status: str) -> dict | None:
+    """
+    Update a message's delivery status. The conversation row is re-stamped
+    (and shows the status when it is the latest message); it is returned.
+    """
+    msg = email_received.find_one_and_update(
+        {"message_id": message_id},
+        {"$set": {"status": status}},
+        projection={"tb1_id": 1}
+    )
+    if not msg:
+        return None
+    is_latest = {"$eq": ["$last_message_id", {"$literal": message_id}]}
+    return conversations.find_one_and_update(
+        {"tb1_id": msg["tb1_id"]},
+        [{"$set": {
+            "status": {"$cond": [is_latest, status, "$status"]},
+            "updated_at": datetime.now(timezone.utc),
+            "seq": next_inbox_seq()
+        }}],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
 # -----------------------------
 # AI History
 # -----------------------------
@@ -0,0 +1,82 @@
+# database_async.py
+"""
+Async read access for request handlers.
+
+The hot read paths (inbox list, thread pages, lookups) await pymongo's
+native async client instead of blocking the event loop. Anything with
+logic behind it -- customer resolution, id allocation, attachment
+storage, conversation rows -- lives only in database.py; handlers run
+those through run_in_threadpool rather than a second copy here. Indexes
+and collection setup stay in database.py too.
+"""
+from pymongo import AsyncMongoClient
+from search_index import terms_filter
+
+from database import (
+    MONGO_URI, DB_NAME, INBOX_SEQ_SLACK, conversation_search_pipeline, conversation_ids_pipeline,
+    conversation_search_tokens
+)
+
+client = AsyncMongoClient(MONGO_URI, tz_aware=True)
+db = client[DB_NAME]
+
+# -----------------------------
+# Collections
+# -----------------------------
+customers = db["customers"]
+email_received = db["email_received"]
+counters = db["counters"]
+whatsapp_accounts = db["whatsapp_accounts"]
+social_accounts = db["social_accounts"]
+conversations = db["conversations"]
+leases = db["leases"]
+
+
+async def search_conversation_ids(query: str, filters: dict | None = None, limit: int = 1000) -> list:
+    """database.search_conversation_ids(), awaited."""
+    tokens, on_messages = conversation_search_tokens(query)
+    if not tokens:
+        return []
+    if on_messages:
+        pipeline = conversation_search_pipeline(tokens, filters, limit)
+    else:
+        ids = [c["tb1_id"] async for c in customers.find(terms_filter(tokens), {"tb1_id": 1}).sort("last_seen", -1).limit(limit)]
+        if not filters or not ids:
+            return ids
+        pipeline = conversation_ids_pipeline({**filters, "tb1_id": {"$in": ids}}, limit)
+    cursor = await email_received.aggregate(pipeline, allowDiskUse=True)
+    return [g["_id"] async for g in cursor]
+
+async def conversation_ids_with_messages(match: dict, limit: int = 1000) -> list:
+    """tb1_ids with a message matching 'match', most recently active first."""
+    cursor = await email_received.aggregate(conversation_ids_pipeline(match, limit), allowDiskUse=True)
+    return [g["_id"] async for g in cursor]
+
+async def attachment_entry(file_id: str, filename: str) -> dict | None:
+    """A message's attachment entry for this stored file and filename, if any."""
+    entry = {"filename": filename}
+    doc = await email_received.find_one(
+        {"$or": [
+            {"attachments": {"$elemMatch": {"file_id": file_id, **entry}}},
+            {"attachments": {"$elemMatch": {"id": file_id, **entry}}}
+        ]},
+        {"attachments": 1}
+    )
+    if not doc:
+        return None
+    return next(
+        (a for a in doc["attachments"] if (a.get("file_id") or a.get("id")) == file_id and a.get("filename") == filename),
+        None
+    )
+
+async def current_inbox_seq() -> int:
+    doc = await counters.find_one({"_id": "inbox_seq"})
+    return int(doc["seq"]) if doc else 0
+
+async def conversation_changes_since(seq: int, limit: int) -> list:
+    """database.conversation_changes_since(), awaited."""
+    since = max(seq - INBOX_SEQ_SLACK, 0)
+    return await conversations.find({"seq": {"$gt": since}}, {"_id": 0}).sort("seq", 1).limit(limit).to_list()
+
+async def get_lease(name: str) -> dict | None:
+    return await leases.find_one({"_id": name})
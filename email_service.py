@@ -1,5 +1,4 @@
 import logging
-import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
@@ -7,6 +6,7 @@ from email import encoders
 from email.utils import make_msgid
 from datetime import datetime
 from database import ensure_customer, email_sent, threads, email_accounts
+from smtp_pool import POOL
 import os
 
 logging.basicConfig(
@@ -24,7 +24,15 @@ ADMIN_EMAIL = os.environ.get("ADMIN_EMAIL", "samikshajagne7@gmail.com")
 # -------------------------------------------------
 # LOW-LEVEL EMAIL SENDER (THREAD SAFE)
 # -------------------------------------------------
-def _send_raw(
+def _send_raw(**kwargs) -> bool:
+    """Send one email (see _deliver) and wait for the result."""
+    return _queue_send(**kwargs).result()
+
+def _queue_send(**kwargs):
+    """Queue one email on the SMTP delivery workers; the Future resolves to True/False."""
+    return POOL.submit(kwargs.get("sender_email") or SENDER_EMAIL, _deliver, **kwargs)
+
+def _deliver(
     to_email: str,
     subject: str,
     body: str,
@@ -108,11 +116,8 @@ def _send_raw(
         if bcc:
             recipients.extend(bcc)
 
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.starttls()
-        server.login(from_email, password)
-        server.sendmail(from_email, recipients, msg.as_string())
-        server.quit()
+        # Pooled, already logged-in session for this sender (see smtp_pool.py)
+        POOL.send(from_email, password, recipients, msg.as_string())
 
         if log_file:
             with open(log_file, "a") as f:
@@ -152,7 +157,8 @@ def send_admin_and_customer_notifications(visitor_email: str, text: str, visitor
     admin_subject = f"Conversation with {visitor_email}"
     admin_body = text
 
-    sent_admin = _send_raw(
+    # Both go out together, each on its own pooled session
+    sent_admin = _queue_send(
         to_email=ADMIN_EMAIL,
         subject=admin_subject,
         body=admin_body,
@@ -166,7 +172,7 @@ def send_admin_and_customer_notifications(visitor_email: str, text: str, visitor
     cust_subject = "Your conversation with support"
     cust_body = f"{text}\n\nWe will reply shortly."
 
-    sent_cust = _send_raw(
+    sent_cust = _queue_send(
         to_email=visitor_email,
         subject=cust_subject,
         body=cust_body,
@@ -174,6 +180,7 @@ def send_admin_and_customer_notifications(visitor_email: str, text: str, visitor
         in_reply_to=new_admin_msgid,
         references=new_admin_msgid
     )
+    sent_admin, sent_cust = sent_admin.result(), sent_cust.result()
 
     threads.update_one(
         {"visitor_email": visitor_email},
@@ -6,7 +6,17 @@ from email.utils import parsedate_to_datetime
 import re
 import logging
 import os
-from database import threads, email_received, get_email_accounts_with_secrets, fs
+import queue
+import select
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from database import (
+    threads, email_received, get_email_accounts_with_secrets, store_attachment,
+    get_folder_state, save_folder_state, attachment_url
+)
+from imap_pool import POOL
 
 logger = logging.getLogger("gmail_reader")
 logger.setLevel(logging.INFO)
@@ -17,6 +27,29 @@ IMAP_PASSWORD = os.environ.get("IMAP_PASSWORD", "qxsmvqolhuprpkwh")
 IMAP_HOST = "imap.gmail.com"
 IMAP_FOLDER = "INBOX"
 
+# Servers may drop an IDLE after 29 min (RFC 2177); Gmail and NATs often sooner
+IDLE_RENEW_SECONDS = int(os.environ.get("IMAP_IDLE_RENEW", "540"))
+# How quickly an IDLEing watcher notices stop()
+IDLE_STOP_CHECK_SECONDS = 1
+IMAP_TIMEOUT = int(os.environ.get("IMAP_TIMEOUT", "60"))
+
+# First sync of a folder with no saved UID state only looks back this far
+INITIAL_SYNC_DAYS = int(os.environ.get("IMAP_INITIAL_SYNC_DAYS", "7"))
+
+# Messages per header FETCH, and a byte budget per full-body FETCH
+FETCH_BATCH = int(os.environ.get("IMAP_FETCH_BATCH", "100"))
+FETCH_BATCH_BYTES = int(os.environ.get("IMAP_FETCH_BATCH_BYTES", str(8 * 1024 * 1024)))
+HEADER_FETCH = "(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE SUBJECT FROM TO IN-REPLY-TO)])"
+
+# Accounts synced in parallel per cycle, and the wall-clock budget of each
+SYNC_CONCURRENCY = int(os.environ.get("IMAP_SYNC_CONCURRENCY", "8"))
+ACCOUNT_SYNC_TIMEOUT = int(os.environ.get("IMAP_ACCOUNT_TIMEOUT", "120"))
+# Parsed messages buffered between the account workers and the consumer
+STREAM_BUFFER = int(os.environ.get("IMAP_STREAM_BUFFER", "200"))
+
+_UID_RE = re.compile(rb"UID (\d+)")
+_SIZE_RE = re.compile(rb"RFC822\.SIZE (\d+)")
+
 
 def _decode_mime_words(s):
     if not s:
@@ -52,37 +85,29 @@ def _extract_body(msg, content_type="text/plain"):
     return ""
 
 
-def _strip_quoted_text(body):
-    """Removes reply chains like 'On ... wrote:', 'From: ...', etc."""
-    patterns = [
+# Lines that open a quoted reply chain; everything from the first one on is dropped
+_QUOTE_START_RE = re.compile(
+    "|".join([
         r"On\s.*\s?wrote:.*",                         # Gmail reply
         r"From:\s.*",                                 # Forwarded or nested reply
         r"Sent:\s.*",                                 # Outlook style
         r"Subject:\s.*",                              # Subject block
         r"-{2,}\s?Forwarded message\s?-{2,}.*",       # ---- Forwarded message ----
-        r"^\s*>.*$",                                  # Quoted lines (standard email quote)
-    ]
-    
-    cleaned = []
-    # Only skip lines *after* the first match of a reply header
-    in_reply_block = False
-    
-    for line in body.splitlines():
-        line_clean = line.strip()
-        
-        # Check if this line marks the start of a reply block
-        if not in_reply_block:
-            for p in patterns:
-                if re.match(p, line_clean, flags=re.IGNORECASE):
-                    in_reply_block = True
-                    break
-        
-        if not in_reply_block:
-            cleaned.append(line)
-    
-    return "\n".join(cleaned).strip()
+        r"\s*>.*$",                                   # Quoted lines (standard email quote)
+    ]),
+    re.IGNORECASE
+)
 
 
+def _strip_quoted_text(body):
+    """Removes reply chains like 'On ... wrote:', 'From: ...', etc."""
+    lines = body.splitlines()
+    for i, line in enumerate(lines):
+        if _QUOTE_START_RE.match(line.strip()):
+            lines = lines[:i]
+            break
+    return "\n".join(lines).strip()
+
 
 def _save_attachment(part, msg_id):
     """
@@ -99,8 +124,8 @@ def _save_attachment(part, msg_id):
         if not content:
             return None
 
-        # Store in GridFS
-        file_id = fs.put(
+        # Store in GridFS (identical bytes are stored once)
+        file_id = store_attachment(
             content,
             filename=filename,
             content_type=part.get_content_type(),
@@ -109,7 +134,7 @@ def _save_attachment(part, msg_id):
             
         return {
             "filename": filename,
-            "url": f"/api/attachments/{file_id}",
+            "url": attachment_url(file_id, filename),
             "content_type": part.get_content_type(),
             "file_id": str(file_id)
         }
@@ -117,295 +142,668 @@ def _save_attachment(part, msg_id):
         logger.error(f"Failed to save attachment {filename}: {e}")
         return None
 
-def fetch_account_emails(account_config, criteria="UNSEEN", scan_sent_folder=True):
-    """Fetch emails for a SINGLE account config."""
-    results = []
-    
+def _select_state(mail):
+    """(UIDVALIDITY, HIGHESTMODSEQ or None) reported by the last SELECT/EXAMINE."""
+    _, validity = mail.response("UIDVALIDITY")
+    _, modseq = mail.response("HIGHESTMODSEQ")
+    uidvalidity = int(validity[0]) if validity and validity[0] else None
+    highestmodseq = int(modseq[0]) if modseq and modseq[0] else None
+    return uidvalidity, highestmodseq
+
+
+def _head_uid(mail):
+    """
+    Highest UID in use in the selected folder (0 if it is empty): UIDNEXT-1
+    from the SELECT, or the UID of the newest message if none was sent.
+    """
+    _, uidnext = mail.response("UIDNEXT")
+    if uidnext and uidnext[0]:
+        return int(uidnext[0]) - 1
+    typ, data = mail.uid("SEARCH", None, "UID *")
+    uids = data[0].split() if typ == "OK" and data and data[0] else []
+    return max((int(u) for u in uids), default=0)
+
+
+def _uids_to_fetch(mail, state, uidvalidity, criteria):
+    """
+    UIDs in the selected folder that we have not processed yet.
+    With saved state for this UIDVALIDITY that is simply 'last_uid+1:*';
+    otherwise (first sync, or the server renumbered the folder) fall back
+    to 'criteria', or the last INITIAL_SYNC_DAYS days.
+    """
+    if state and state.get("uidvalidity") == uidvalidity and not criteria:
+        last_uid = state.get("last_uid", 0)
+        typ, data = mail.uid("SEARCH", None, f"UID {last_uid + 1}:*")
+        if typ != "OK":
+            return []
+        # 'N:*' always matches the newest message, even when its UID < N
+        return [u for u in data[0].split() if int(u) > last_uid]
+
+    if not criteria:
+        since = (datetime.now() - timedelta(days=INITIAL_SYNC_DAYS)).strftime("%d-%b-%Y")
+        criteria = f'(SINCE "{since}")'
+    typ, data = mail.uid("SEARCH", None, criteria)
+    return data[0].split() if typ == "OK" else []
+
+
+def _fetch_items(data):
+    """
+    Split a UID FETCH response into {uid: (metadata, literal)}.
+    Servers may put 'UID n' before or after the literal, so the trailing
+    bytes item that closes each response is searched too.
+    """
+    items = {}
+    current = None
+    for part in data or []:
+        if isinstance(part, tuple):
+            current = [part[0], part[1]]
+        elif isinstance(part, bytes) and current is not None:
+            current[0] += part
+        else:
+            continue
+        m = _UID_RE.search(current[0])
+        if m:
+            items[m.group(1).decode()] = (current[0], current[1])
+            current = None
+    return items
+
+
+def _clean_message_id(raw):
+    msg_id = (raw or "").strip()
+    # CLEAN MESSAGE-ID: Remove angle brackets to ensure consistency with DB
+    if msg_id.startswith("<") and msg_id.endswith(">"):
+        msg_id = msg_id[1:-1]
+    return msg_id
+
+
+def _route_message(headers, email_addr, folder, thread_map):
+    """
+    Decide from headers alone whether a message belongs in the inbox and
+    for which visitor. Returns the routing fields, or None to skip it.
+    """
+    subject = _decode_mime_words(headers.get("Subject", ""))
+    from_raw = _decode_mime_words(headers.get("From", ""))
+    to_raw = _decode_mime_words(headers.get("To", ""))
+    in_reply_to = headers.get("In-Reply-To", "").strip().strip("<>")
+
+    email_date = None
+    try:
+        date_header = headers.get("Date")
+        if date_header:
+            email_date = parsedate_to_datetime(date_header)
+    except Exception:
+        pass
+
+    sender_name = None
+    if "<" in from_raw:
+        parts = from_raw.split("<")
+        sender_name = parts[0].strip().strip('"')
+        from_email = parts[-1].split(">")[0].strip().lower()
+    else:
+        from_email = from_raw.strip().lower()
+
+    logger.info(f"[{email_addr}/{folder}] Subj='{subject}', From='{from_email}'")
+
+    # Determine SENDER
+    is_admin = (from_email == email_addr.lower())
+    sender = "admin" if is_admin else "visitor"
+
+    # Determine VISITOR email
+    visitor = None
+    if in_reply_to in thread_map:
+        visitor = thread_map[in_reply_to]
+
+    if not visitor:
+        match = re.search(r"Conversation with\s+([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})", subject, re.IGNORECASE)
+        if match:
+            visitor = match.group(1).lower()
+
+    if not visitor and is_admin:
+         if "<" in to_raw:
+             to_email = to_raw.split("<")[-1].split(">")[0].strip().lower()
+         else:
+             to_email = to_raw.strip().lower()
+
+         if to_email != email_addr.lower() and "support" not in to_email:
+             visitor = to_email
+
+    if not visitor or (visitor == email_addr.lower()):
+        return None
+
+    # --- NEW: Filter internal system notifications ---
+    # These are automated alerts/acks that we don't want to show as 'messages' in the dashboard chat
+    # because they are duplicates of widget activity.
+    is_automated = (
+        subject == "Your conversation with support" or
+        (subject.lower().startswith("conversation with ") and not subject.lower().startswith("re:"))
+    )
+    if is_automated:
+        logger.info(f"Ignoring automated notification email: {subject}")
+        return None
+
+    return {
+        "visitor": visitor,
+        "sender": sender,
+        "sender_name": sender_name,
+        "timestamp": email_date,
+        "in_reply_to": in_reply_to
+    }
+
+
+def _parse_body(msg, msg_id):
+    """Text body, HTML body and saved attachments of a full message."""
+    body_parts = []
+    html_parts = []
+    attachments = []
+
+    if msg.is_multipart():
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            content_disposition = str(part.get("Content-Disposition"))
+            filename = part.get_filename()
+
+            if filename:
+                 filename = _decode_mime_words(filename) # Decode filename here too
+                 is_attachment = "attachment" in content_disposition or "inline" in content_disposition
+                 if not is_attachment and filename:
+                     if content_type not in ["text/plain", "text/html"]:
+                         is_attachment = True
+
+                 if is_attachment:
+                    att = _save_attachment(part, msg_id)
+                    if att:
+                        # Capture Content-ID for inline images
+                        cid = part.get("Content-ID")
+                        if cid:
+                            att["content_id"] = cid.strip()
+                        attachments.append(att)
+
+            if content_type == "text/plain" and "attachment" not in content_disposition:
+                try:
+                    body_parts.append(part.get_payload(decode=True).decode(errors="ignore"))
+                except:
+                    pass
+
+            # Capture HTML if available
+            if content_type == "text/html" and "attachment" not in content_disposition:
+                 try:
+                    html = part.get_payload(decode=True).decode(errors="ignore")
+                    # Basic check to avoid empty html parts overriding
+                    if html and len(html) > 10:
+                        html_parts.append(html)
+                 except:
+                     pass
+
+    else:
+        try:
+            payload = msg.get_payload(decode=True).decode(errors="ignore")
+            body_parts.append(payload)
+            if msg.get_content_type() == "text/html":
+                html_parts.append(payload)
+        except:
+            pass
+
+    full_body = "\n".join(body_parts)
+    full_html = "".join(html_parts) if html_parts else None
+
+    # Rewrite CID images in HTML
+    if full_html and attachments:
+        for att in attachments:
+            cid = att.get("content_id")
+            if cid and cid.startswith('<') and cid.endswith('>'):
+                cid = cid[1:-1] # strip angle brackets
+
+            if cid:
+                # Replace cid:header_value with /api/attachments/file_id
+                full_html = full_html.replace(f'cid:{cid}', att["url"])
+
+    return full_body, full_html, attachments
+
+
+def _body_batches(uids, sizes):
+    """Group UIDs so each body FETCH stays under FETCH_BATCH_BYTES."""
+    batch, total = [], 0
+    for uid in uids:
+        size = sizes.get(uid, 0)
+        if batch and total + size > FETCH_BATCH_BYTES:
+            yield batch
+            batch, total = [], 0
+        batch.append(uid)
+        total += size
+    if batch:
+        yield batch
+
+
+def _fetch_batch(mail, uids, email_addr, folder, thread_map, failed):
+    """
+    Ingest one set of UIDs from the selected folder in three round trips:
+    headers for the whole set, one $in lookup to drop messages we already
+    stored, then full bodies only for new messages we will actually keep.
+    Parsed messages are yielded one at a time; UIDs that could not be read
+    are added to 'failed' (ints) so the folder checkpoint stops before them.
+    """
+    uids = [u.decode() if isinstance(u, bytes) else u for u in uids]
+    typ, data = mail.uid("FETCH", ",".join(uids), HEADER_FETCH)
+    if typ != "OK":
+        failed.extend(int(u) for u in uids)
+        return
+
+    candidates = {}
+    sizes = {}
+    for uid, (meta, literal) in _fetch_items(data).items():
+        try:
+            headers = email.message_from_bytes(literal or b"")
+            m = _SIZE_RE.search(meta)
+            sizes[uid] = int(m.group(1)) if m else 0
+            candidates[uid] = (_clean_message_id(headers.get("Message-ID")), headers)
+        except Exception as e_inner:
+            logger.exception(f"Error reading headers of message {uid}: {e_inner}")
+            failed.append(int(uid))
+
+    # 🛑 DEDUPLICATION: one query for the whole batch
+    msg_ids = [mid for mid, _ in candidates.values() if mid]
+    known = set()
+    if msg_ids:
+        known = set(email_received.distinct("message_id", {"message_id": {"$in": msg_ids}}))
+        # Older rows predate multi-account sync
+        email_received.update_many(
+            {"message_id": {"$in": list(known)}, "account_email": {"$exists": False}},
+            {"$set": {"account_email": email_addr}}
+        )
+
+    routed = {}
+    for uid, (msg_id, headers) in candidates.items():
+        if msg_id and msg_id in known:
+            continue
+        route = _route_message(headers, email_addr, folder, thread_map)
+        if route:
+            route["message_id"] = msg_id
+            routed[uid] = route
+
+    for body_uids in _body_batches(sorted(routed, key=int), sizes):
+        typ, data = mail.uid("FETCH", ",".join(body_uids), "(UID BODY.PEEK[])")
+        if typ != "OK":
+            failed.extend(int(u) for u in body_uids)
+            continue
+        items = _fetch_items(data)
+        # Asked for but not returned (e.g. expunged meanwhile): try again next cycle
+        failed.extend(int(u) for u in body_uids if u not in items)
+        for uid, (_, raw) in items.items():
+            route = routed.get(uid)
+            if not route:
+                continue
+            try:
+                msg = email.message_from_bytes(raw)
+                full_body, full_html, attachments = _parse_body(msg, route["message_id"])
+                yield {
+                    **route,
+                    "body": _strip_quoted_text(full_body).strip(),
+                    "source": "imap",
+                    "attachments": attachments,
+                    "account_email": email_addr,
+                    "html_content": full_html,
+                    "imap_folder": folder,
+                    "imap_uid": int(uid)
+                }
+            except Exception as e_inner:
+                logger.exception(f"Error processing message {uid}: {e_inner}")
+                failed.append(int(uid))
+
+
+def fetch_account_emails(account_config, criteria=None, scan_sent_folder=True, scan_inbox=True, deadline=None):
+    """
+    Fetch emails for a SINGLE account config, yielding parsed messages one
+    batch at a time so a large folder is never held in memory.
+    By default only mail newer than the saved per-folder UID state is read
+    (a cheap delta); pass an IMAP search 'criteria' to rescan explicitly.
+    Folders are opened read-only, so \\Seen flags are never touched.
+    Past 'deadline' (time.monotonic()) it stops after the current batch;
+    the saved UID state lets the next cycle carry on from there.
+
+    After each batch a {"checkpoint": ...} item follows its messages. The
+    consumer saves it (see FolderProgress) once those messages are stored;
+    nothing here writes the UID state. A folder stops at its first UID
+    that could not be fetched, so that UID is read again next cycle.
+    """
     email_addr = account_config.get("email")
     password = account_config.get("app_password")
     host = account_config.get("imap_host", "imap.gmail.com")
     
     if not password:
-        return []
+        return
 
     try:
-        mail = imaplib.IMAP4_SSL(host)
-        mail.login(email_addr, password)
-        
-        # Determine folders to scan
-        folders_to_scan = ["INBOX"]
-        
-        if scan_sent_folder:
-            # Try to identify Sent folder
-            sent_folder = None
-            list_typ, list_data = mail.list()
-            if list_typ == "OK":
-                for f in list_data:
-                    decoded = f.decode()
-                    match = re.search(r'\((?P<flags>.*?)\) "(?P<delim>.*?)" (?P<name>.*)', decoded)
-                    if match:
-                        name_raw = match.group("name")
-                        name = name_raw.strip('"')
-                        
-                        if "Sent" in name and "Trash" not in name:
-                             if "Gmail" in name or name == "Sent":
-                                 sent_folder = name
-            
-            if sent_folder:
-                folders_to_scan.append(sent_folder)
-            else:
-                 if "[Gmail]/Sent Mail" not in folders_to_scan:
-                     folders_to_scan.append("[Gmail]/Sent Mail")
-
-
-        # Load all threads for mapping
-        thread_map = {
-            t["admin_msgid"].strip("<>"): t["visitor_email"]
-            for t in threads.find()
-            if "admin_msgid" in t
-        }
-
-        for folder in folders_to_scan:
-            try:
-                if " " in folder and not folder.startswith('"'):
-                    folder_quoted = f'"{folder}"'
-                else:
-                    folder_quoted = folder
+        with POOL.session(host, email_addr, password) as mail:
+            # Determine folders to scan
+            folders_to_scan = ["INBOX"] if scan_inbox else []
+            if scan_sent_folder:
+                folders_to_scan.append(POOL.sent_folder(host, email_addr, password, mail))
+
+            # Load all threads for mapping
+            thread_map = {
+                t["admin_msgid"].strip("<>"): t["visitor_email"]
+                for t in threads.find()
+                if "admin_msgid" in t
+            }
+
+            for folder in folders_to_scan:
+                try:
+                    if " " in folder and not folder.startswith('"'):
+                        folder_quoted = f'"{folder}"'
+                    else:
+                        folder_quoted = folder
 
-                rv, _ = mail.select(folder_quoted)
-                if rv != "OK":
-                    continue
+                    rv, _ = mail.select(folder_quoted, readonly=True)
+                    if rv != "OK":
+                        continue
 
-                typ, data = mail.search(None, criteria)
-                if typ != "OK":
-                    continue
-                
-                msg_nums = data[0].split()
-                if not msg_nums:
-                    continue
+                    uidvalidity, highestmodseq = _select_state(mail)
+                    state = get_folder_state(email_addr, folder)
 
-                for num in msg_nums:
-                    try:
-                        typ, msg_data = mail.fetch(num, "(RFC822)")
-                        if typ != "OK":
-                            continue
-
-                        raw = msg_data[0][1]
-                        msg = email.message_from_bytes(raw)
-
-                        msg_id = msg.get("Message-ID", "").strip()
-                        # CLEAN MESSAGE-ID: Remove angle brackets to ensure consistency with DB
-                        if msg_id.startswith("<") and msg_id.endswith(">"):
-                            msg_id = msg_id[1:-1]
-
-                        email_date = None
-                        try:
-                            date_header = msg.get("Date")
-                            if date_header:
-                                email_date = parsedate_to_datetime(date_header)
-                        except Exception:
-                            pass
-
-                        # 🛑 DEDUPLICATION / UPDATE CHECK
-                        # We perform a strict check on message_id to prevent processing the same email twice.
-                        existing_doc = email_received.find_one({"message_id": msg_id})
-                        
-                        # Parse body & attachments FIRST to see if we have new info
-                        subject = _decode_mime_words(msg.get("Subject", ""))
-                        from_raw = _decode_mime_words(msg.get("From", ""))
-                        to_raw = _decode_mime_words(msg.get("To", ""))
-                        in_reply_to = msg.get("In-Reply-To", "").strip("<>")
-
-                        sender_name = None
-                        if "<" in from_raw:
-                            parts = from_raw.split("<")
-                            sender_name = parts[0].strip().strip('"')
-                            from_email = parts[-1].split(">")[0].strip().lower()
-                        else:
-                            from_email = from_raw.strip().lower()
-
-                        # BODY & ATTACHMENTS extraction
-                        body_parts = []
-                        html_parts = []
-                        attachments = []
-                        
-                        if msg.is_multipart():
-                            for part in msg.walk():
-                                content_type = part.get_content_type()
-                                content_disposition = str(part.get("Content-Disposition"))
-                                filename = part.get_filename()
-
-                                if filename:
-                                     filename = _decode_mime_words(filename) # Decode filename here too
-                                     is_attachment = "attachment" in content_disposition or "inline" in content_disposition
-                                     if not is_attachment and filename:
-                                         if content_type not in ["text/plain", "text/html"]:
-                                             is_attachment = True
-                                     
-                                     if is_attachment:
-                                        att = _save_attachment(part, msg_id)
-                                        if att:
-                                            # Capture Content-ID for inline images
-                                            cid = part.get("Content-ID")
-                                            if cid:
-                                                att["content_id"] = cid.strip()
-                                            attachments.append(att)
-                                
-                                if content_type == "text/plain" and "attachment" not in content_disposition:
-                                    try:
-                                        body_parts.append(part.get_payload(decode=True).decode(errors="ignore"))
-                                    except:
-                                        pass
-                                
-                                # Capture HTML if available
-                                if content_type == "text/html" and "attachment" not in content_disposition:
-                                     try:
-                                        html = part.get_payload(decode=True).decode(errors="ignore")
-                                        # Basic check to avoid empty html parts overriding
-                                        if html and len(html) > 10: 
-                                            html_parts.append(html)
-                                     except:
-                                         pass
-
-                        else:
-                            try:
-                                payload = msg.get_payload(decode=True).decode(errors="ignore")
-                                body_parts.append(payload)
-                                if msg.get_content_type() == "text/html":
-                                    html_parts.append(payload)
-                            except:
-                                pass
-                        
-                        full_body = "\n".join(body_parts)
-                        full_html = "".join(html_parts) if html_parts else None
-
-                        # Rewrite CID images in HTML
-                        if full_html and attachments:
-                            for att in attachments:
-                                cid = att.get("content_id")
-                                if cid and cid.startswith('<') and cid.endswith('>'):
-                                    cid = cid[1:-1] # strip angle brackets
-                                
-                                if cid:
-                                    # Replace cid:header_value with /api/attachments/file_id
-                                    # Regex to catch src="cid:..." ignoring quotes/spaces variations slightly
-                                    # Simple replacement for now
-                                    full_html = full_html.replace(f'cid:{cid}', att["url"])
-
-
-                        body_clean = _strip_quoted_text(full_body)
-
-                        # Logic: If existing doc, UPDATE it with attachments if missing
-                        if existing_doc:
-                            # Update DB if attachments found OR account_email missing OR html missing
-                            update_fields = {}
-                            if attachments:
-                                update_fields["attachments"] = attachments
-                            if "account_email" not in existing_doc:
-                                update_fields["account_email"] = email_addr
-                            if full_html and "html_content" not in existing_doc:
-                                update_fields["html_content"] = full_html
-                            
-                            if update_fields:
-                                email_received.update_one(
-                                    {"_id": existing_doc["_id"]},
-                                    {"$set": update_fields}
-                                )
-                                logger.info(f"Updated existing msg {msg_id} with {update_fields.keys()}")
-                            continue # Move to next email (don't re-insert)
-
-                        logger.info(f"[{email_addr}/{folder}] Subj='{subject}', From='{from_email}'")
-
-
-                        # Determine SENDER
-                        is_admin = (from_email == email_addr.lower())
-                        sender = "admin" if is_admin else "visitor"
-
-                        # Determine VISITOR email
-                        visitor = None
-                        if in_reply_to in thread_map:
-                            visitor = thread_map[in_reply_to]
-                        
-                        if not visitor:
-                            match = re.search(r"Conversation with\s+([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})", subject, re.IGNORECASE)
-                            if match:
-                                visitor = match.group(1).lower()
-
-                        if not visitor and is_admin:
-                             if "<" in to_raw:
-                                 to_email = to_raw.split("<")[-1].split(">")[0].strip().lower()
-                             else:
-                                 to_email = to_raw.strip().lower()
-                             
-                             if to_email != email_addr.lower() and "support" not in to_email:
-                                 visitor = to_email
-
-                        if not visitor or (visitor == email_addr.lower()):
-                            continue
-
-                        # --- NEW: Filter internal system notifications ---
-                        # These are automated alerts/acks that we don't want to show as 'messages' in the dashboard chat
-                        # because they are duplicates of widget activity.
-                        is_automated = (
-                            subject == "Your conversation with support" or 
-                            (subject.lower().startswith("conversation with ") and not subject.lower().startswith("re:"))
-                        )
-                        if is_automated:
-                            logger.info(f"Ignoring automated notification email: {subject}")
-                            mail.store(num, "+FLAGS", "\\Seen") # Mark as seen anyway
-                            continue
-
-                        results.append({
-                            "visitor": visitor,
-                            "sender": sender,
-                            "sender_name": sender_name,
-                            "body": body_clean.strip(),
-                            "source": "imap",
-                            "message_id": msg_id,
-                            "timestamp": email_date,
-                            "attachments": attachments,
-                            "account_email": email_addr,
-                            "html_content": full_html,
-                            "in_reply_to": in_reply_to
-                        })
-
-                        mail.store(num, "+FLAGS", "\\Seen")
-
-                    except Exception as e_inner:
-                        logger.exception(f"Error processing message {num}: {e_inner}")
+                    # CONDSTORE: an unchanged HIGHESTMODSEQ means nothing to do
+                    if (not criteria and state and highestmodseq
+                            and state.get("uidvalidity") == uidvalidity
+                            and state.get("highestmodseq") == highestmodseq):
                         continue
-            except Exception as e_folder:
-                 logger.error(f"Error accessing folder {folder}: {e_folder}")
-                 continue
 
-        mail.logout()
+                    resumed = bool(state and state.get("uidvalidity") == uidvalidity)
+                    # First sync only reads a window: once it is done, the folder's
+                    # head is the checkpoint, or the next delta would be 'UID 1:*'
+                    head_uid = 0 if resumed else _head_uid(mail)
+                    uids = sorted(_uids_to_fetch(mail, state, uidvalidity, criteria), key=int)
+                    last_uid = state.get("last_uid", 0) if resumed else 0
+
+                    def checkpoint(**fields):
+                        return {"checkpoint": {
+                            "account": email_addr, "folder": folder, "uidvalidity": uidvalidity,
+                            "last_uid": last_uid, "highestmodseq": None, "failed_uid": None, **fields
+                        }}
+
+                    for i in range(0, len(uids), FETCH_BATCH):
+                        if deadline and time.monotonic() > deadline:
+                            logger.warning(f"[{email_addr}/{folder}] Sync time budget spent; resuming next cycle")
+                            break
+                        batch = uids[i:i + FETCH_BATCH]
+                        failed = []
+                        yield from _fetch_batch(mail, batch, email_addr, folder, thread_map, failed)
+                        if failed:
+                            first = min(failed)
+                            logger.warning(f"[{email_addr}/{folder}] Could not fetch UID {first}; stopping before it")
+                            yield checkpoint(last_uid=max(last_uid, first - 1), failed_uid=first)
+                            break
+                        last_uid = max(last_uid, int(batch[-1]))
+                        yield checkpoint()
+                    else:
+                        # Whole folder read: remember HIGHESTMODSEQ for the CONDSTORE skip
+                        yield checkpoint(last_uid=max(last_uid, head_uid), highestmodseq=highestmodseq)
+                except (imaplib.IMAP4.abort, OSError):
+                    raise  # Connection is gone; don't hand it back to the pool
+                except Exception as e_folder:
+                     logger.error(f"Error accessing folder {folder}: {e_folder}")
+                     continue
     except Exception as e:
         logger.error(f"IMAP error for {email_addr}: {e}")
-    
-    return results
 
 
-def fetch_emails(criteria="UNSEEN", scan_sent_folder=True):
-    """Fetch emails from ALL configured accounts."""
-    all_results = []
-    
-    # 1. Fetch from DB accounts
-    db_accounts = get_email_accounts_with_secrets()
-    for acc in db_accounts:
-        all_results.extend(fetch_account_emails(acc, criteria, scan_sent_folder))
-        
-    # 2. Fetch from ENV account (legacy support)
+class FolderProgress:
+    """
+    Saves the checkpoints of a fetch stream (see fetch_account_emails) once
+    the messages before them are stored. Messages that failed to store hold
+    their folder's checkpoint back to just before the first of them.
+    """
+
+    def __init__(self):
+        self._failed = {}       # (account, folder) -> lowest UID not stored
+        self._stopped = set()   # folders whose state was already held back
+
+    def failed(self, results):
+        """Report results (sync items) that were not stored."""
+        for r in results:
+            if "imap_uid" in r:
+                key = (r["account_email"], r["imap_folder"])
+                self._failed[key] = min(self._failed.get(key, r["imap_uid"]), r["imap_uid"])
+
+    def save(self, checkpoint):
+        key = (checkpoint["account"], checkpoint["folder"])
+        if key in self._stopped:
+            return
+        first = self._failed.get(key)
+        if first is not None and first <= checkpoint["last_uid"]:
+            checkpoint = {**checkpoint, "last_uid": first - 1, "highestmodseq": None, "failed_uid": first}
+        if checkpoint["failed_uid"] is not None:
+            self._stopped.add(key)
+        save_folder_state(
+            checkpoint["account"], checkpoint["folder"], checkpoint["uidvalidity"], checkpoint["last_uid"],
+            checkpoint["highestmodseq"], failed_uid=checkpoint["failed_uid"]
+        )
+
+
+def configured_accounts():
+    """All accounts to sync: DB accounts plus the legacy ENV account."""
+    # 1. DB accounts
+    accounts = list(get_email_accounts_with_secrets())
+
+    # 2. ENV account (legacy support)
     if IMAP_EMAIL and IMAP_PASSWORD:
-         env_acc = {
-             "email": IMAP_EMAIL,
-             "app_password": IMAP_PASSWORD,
-             "imap_host": IMAP_HOST
-         }
          # Avoid duplicate processing if same email is in DB
-         if not any(a["email"] == IMAP_EMAIL.lower() for a in db_accounts):
-             all_results.extend(fetch_account_emails(env_acc, criteria, scan_sent_folder))
+         if not any(a["email"] == IMAP_EMAIL.lower() for a in accounts):
+             accounts.append({
+                 "email": IMAP_EMAIL,
+                 "app_password": IMAP_PASSWORD,
+                 "imap_host": IMAP_HOST
+             })
+    return accounts
+
+
+_account_locks = {}
+_account_locks_guard = threading.Lock()
+
+
+def account_lock(email_addr):
+    """
+    Lock held while one account is fetched and its checkpoints saved, so
+    two fetches of the same account never race on its UID state. Other
+    accounts are unaffected.
+    """
+    with _account_locks_guard:
+        return _account_locks.setdefault(email_addr.lower(), threading.Lock())
+
+
+def fetch_emails(criteria=None, scan_sent_folder=True, scan_inbox=True):
+    """
+    Fetch emails from ALL configured accounts, up to SYNC_CONCURRENCY at a
+    time, yielding parsed messages as they arrive. Workers block once
+    STREAM_BUFFER messages are waiting, so memory stays bounded however
+    big the mailboxes are. Accounts stop after their time budget; if
+    nothing at all arrives for a full budget the rest are abandoned.
+
+    Each account is fetched under its account_lock(), which is held until
+    the consumer sets the {"saved": Event} item that ends the account's
+    items, i.e. until its checkpoints are stored.
+    """
+    accounts = configured_accounts()
+    if not accounts:
+        return
+
+    out = queue.Queue(maxsize=STREAM_BUFFER)
+    cancelled = threading.Event()
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                out.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(acc):
+        with account_lock(acc["email"]):
+            deadline = time.monotonic() + ACCOUNT_SYNC_TIMEOUT
+            for item in fetch_account_emails(acc, criteria, scan_sent_folder, scan_inbox, deadline=deadline):
+                if not put(item):
+                    return
+            saved = threading.Event()
+            if not put({"saved": saved}):
+                return
+            while not saved.wait(1):
+                if cancelled.is_set():
+                    return
+
+    pool = ThreadPoolExecutor(max_workers=min(SYNC_CONCURRENCY, len(accounts)), thread_name_prefix="imap-sync")
+    futures = {pool.submit(run, acc): acc["email"] for acc in accounts}
+    stall_limit = ACCOUNT_SYNC_TIMEOUT + IMAP_TIMEOUT
+    last_progress = time.monotonic()
+    reported = set()
+    try:
+        while True:
+            try:
+                item = out.get(timeout=0.5)
+            except queue.Empty:
+                for future in futures:
+                    if future.done() and future not in reported:
+                        reported.add(future)
+                        last_progress = time.monotonic()
+                        if future.exception():
+                            logger.error(f"IMAP sync failed for {futures[future]}: {future.exception()}")
+                if len(reported) == len(futures) and out.empty():
+                    return
+                if time.monotonic() - last_progress > stall_limit:
+                    for future in futures:
+                        if not future.done():
+                            logger.error(f"IMAP sync timed out for {futures[future]}")
+                    return
+                continue
+            last_progress = time.monotonic()
+            yield item
+    finally:
+        cancelled.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+# -----------------------------
+# IMAP IDLE (push) watchers
+# -----------------------------
+def _idle_wait(mail, timeout, stop=None):
+    """
+    Run one IDLE cycle on the selected mailbox. Returns True as soon as the
+    server reports new mail (EXISTS), False once 'timeout' seconds pass or
+    the 'stop' event is set (checked every IDLE_STOP_CHECK_SECONDS).
+    imaplib has no IDLE support, so the command is driven by hand.
+    """
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    resp = mail.readline()
+    if not resp.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {resp!r}")
+
+    changed = False
+    deadline = time.monotonic() + timeout
+    while not changed:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or (stop is not None and stop.is_set()):
+            break
+        # select() cannot see bytes already decrypted inside the SSL layer
+        if not mail.sock.pending():
+            ready, _, _ = select.select([mail.sock], [], [], min(remaining, IDLE_STOP_CHECK_SECONDS))
+            if not ready:
+                continue
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        if line.rstrip().endswith(b"EXISTS"):
+            changed = True
+
+    mail.send(b"DONE\r\n")
+    # Drain untagged updates that raced with DONE, up to our tagged reply
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed ending IDLE")
+        if line.startswith(tag):
+            break
+        if line.rstrip().endswith(b"EXISTS"):
+            changed = True
+    return changed
+
+
+class MailboxWatcher(threading.Thread):
+    """
+    Keeps one IMAP connection per account IDLEing on INBOX and calls
+    on_new_mail(account_config) whenever mail arrives. Re-IDLEs every
+    IDLE_RENEW_SECONDS so servers never time the session out; reconnects
+    with backoff on errors. Servers without IDLE are polled instead.
+    """
+
+    POLL_SECONDS = 10
+
+    def __init__(self, account_config, on_new_mail):
+        super().__init__(name=f"imap-idle-{account_config.get('email')}", daemon=True)
+        self.account = account_config
+        self.on_new_mail = on_new_mail
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        email_addr = self.account.get("email")
+        backoff = 1
+        while not self._stop_event.is_set():
+            mail = None
+            try:
+                mail = imaplib.IMAP4_SSL(self.account.get("imap_host", "imap.gmail.com"), timeout=IMAP_TIMEOUT)
+                mail.login(email_addr, self.account.get("app_password"))
+                mail.select("INBOX", readonly=True)
+                typ, caps = mail.capability()
+                supports_idle = typ == "OK" and b"IDLE" in caps[0].upper().split()
+                if not supports_idle:
+                    logger.warning(f"[{email_addr}] Server lacks IDLE; polling every {self.POLL_SECONDS}s")
+                backoff = 1
+
+                # Catch up on anything that arrived while disconnected
+                self.on_new_mail(self.account)
+
+                while not self._stop_event.is_set():
+                    if supports_idle:
+                        changed = _idle_wait(mail, IDLE_RENEW_SECONDS, self._stop_event)
+                    else:
+                        self._stop_event.wait(self.POLL_SECONDS)
+                        changed = True
+                    if changed and not self._stop_event.is_set():
+                        self.on_new_mail(self.account)
+            except Exception as e:
+                logger.error(f"[{email_addr}] IDLE watcher error: {e}; reconnecting in {backoff}s")
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, 300)
+            finally:
+                if mail is not None:
+                    try:
+                        mail.logout()
+                    except Exception:
+                        pass
+
+
+def sync_watchers(watchers, on_new_mail):
+    """
+    Start a MailboxWatcher for every configured account and stop those for
+    removed accounts. 'watchers' (email -> MailboxWatcher) is updated in place.
+    """
+    accounts = {a["email"].lower(): a for a in configured_accounts() if a.get("app_password")}
+    for email_addr in list(watchers):
+        if email_addr not in accounts or not watchers[email_addr].is_alive():
+            watchers.pop(email_addr).stop()
+    for email_addr, acc in accounts.items():
+        if email_addr not in watchers:
+            watcher = MailboxWatcher(acc, on_new_mail)
+            watcher.start()
+            watchers[email_addr] = watcher
+
 
-    return all_results
+def stop_watchers(watchers):
+    for watcher in watchers.values():
+        watcher.stop()
+    watchers.clear()
 
 
 def test_credentials(email_addr, password, host="imap.gmail.com"):
@@ -414,9 +812,7 @@ def test_credentials(email_addr, password, host="imap.gmail.com"):
     Returns: (bool, str) -> (Success, Error Message)
     """
     try:
-        mail = imaplib.IMAP4_SSL(host)
-        mail.login(email_addr, password)
-        mail.logout()
+        POOL.verify(host, email_addr, password)
         return True, None
     except imaplib.IMAP4.error as e:
         return False, f"IMAP authentication failed: {e}"
@@ -0,0 +1,209 @@
+# imap_pool.py
+"""
+Reusable authenticated IMAP sessions.
+
+Opening a session costs a TLS handshake plus LOGIN, and finding the Sent
+folder costs a LIST. The pool keeps idle sessions per account, pings
+them with NOOP so servers don't time them out, and caches the folder
+list. An account whose connection attempts fail is backed off
+exponentially rather than hammered every cycle.
+
+IDLE watchers keep their own dedicated connection (see gmail_reader).
+"""
+import imaplib
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("imap_pool")
+
+IMAP_TIMEOUT = int(os.environ.get("IMAP_TIMEOUT", "60"))
+# NOOP idle sessions this often; most servers drop them after ~30 min
+KEEPALIVE_SECONDS = int(os.environ.get("IMAP_KEEPALIVE", "240"))
+# Idle sessions kept per account (sync of INBOX and Sent may overlap)
+MAX_IDLE_PER_ACCOUNT = int(os.environ.get("IMAP_POOL_SIZE", "2"))
+MAX_BACKOFF_SECONDS = 300
+
+_LIST_RE = re.compile(r'\((?P<flags>.*?)\) "(?P<delim>.*?)" (?P<name>.*)')
+
+
+class _Account:
+    """Pool state for one mailbox."""
+
+    def __init__(self, password):
+        self.password = password
+        self.idle = []              # [(IMAP4_SSL, last_used monotonic)]
+        self.folders = None         # cached LIST result (names)
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+class ImapPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._accounts: dict[tuple, _Account] = {}
+        self._keepalive = None
+
+    # -----------------------------
+    # Sessions
+    # -----------------------------
+    def _entry(self, host, email_addr, password) -> _Account:
+        key = (host, email_addr.lower())
+        with self._lock:
+            entry = self._accounts.get(key)
+            if entry is None or entry.password != password:
+                # New account or changed password: old sessions are stale
+                if entry is not None:
+                    self._close_all(entry.idle)
+                entry = self._accounts[key] = _Account(password)
+            return entry
+
+    def _connect(self, host, email_addr, password, entry):
+        now = time.monotonic()
+        with self._lock:
+            retry_at = entry.retry_at
+        if now < retry_at:
+            raise imaplib.IMAP4.abort(
+                f"{email_addr}: reconnect backoff ({int(retry_at - now)}s left)"
+            )
+        try:
+            mail = imaplib.IMAP4_SSL(host, timeout=IMAP_TIMEOUT)
+            mail.login(email_addr, password)
+        except Exception:
+            with self._lock:
+                entry.failures += 1
+                entry.retry_at = time.monotonic() + min(2 ** entry.failures, MAX_BACKOFF_SECONDS)
+            raise
+        with self._lock:
+            entry.failures = 0
+            entry.retry_at = 0.0
+        return mail
+
+    def _checkout(self, host, email_addr, password):
+        entry = self._entry(host, email_addr, password)
+        while True:
+            with self._lock:
+                if not entry.idle:
+                    break
+                mail, last_used = entry.idle.pop()
+            if time.monotonic() - last_used < KEEPALIVE_SECONDS:
+                return mail, entry
+            # Idle long enough that the server may have dropped it
+            try:
+                mail.noop()
+                return mail, entry
+            except Exception:
+                self._close_all([(mail, 0)])
+        return self._connect(host, email_addr, password, entry), entry
+
+    def _checkin(self, mail, entry):
+        with self._lock:
+            if len(entry.idle) < MAX_IDLE_PER_ACCOUNT:
+                entry.idle.append((mail, time.monotonic()))
+                self._ensure_keepalive()
+                return
+        self._close_all([(mail, 0)])
+
+    @contextmanager
+    def session(self, host, email_addr, password):
+        """
+        Borrow a logged-in session. It goes back to the pool when the block
+        exits cleanly and is discarded otherwise -- including when a generator
+        holding it is closed early (GeneratorExit), which may leave a command
+        half read.
+        """
+        mail, entry = self._checkout(host, email_addr, password)
+        try:
+            yield mail
+        except BaseException:
+            self._close_all([(mail, 0)])
+            raise
+        else:
+            self._checkin(mail, entry)
+
+    def verify(self, host, email_addr, password):
+        """Check credentials, reusing a pooled session when one exists."""
+        with self._lock:
+            entry = self._accounts.get((host, email_addr.lower()))
+        if entry is not None and entry.password == password:
+            with self._lock:
+                entry.retry_at = 0.0  # explicit test: never refuse because of backoff
+            with self.session(host, email_addr, password) as mail:
+                mail.noop()
+            return
+
+        # Unknown or different credentials: log in on the side, so a wrong
+        # password cannot evict the sessions of a working one
+        mail = self._connect(host, email_addr, password, _Account(password))
+        if entry is None:
+            # New account: the first sync can reuse this session
+            self._checkin(mail, self._entry(host, email_addr, password))
+        else:
+            self._close_all([(mail, 0)])
+
+    # -----------------------------
+    # Folder cache
+    # -----------------------------
+    def folders(self, host, email_addr, password, mail) -> list[str]:
+        """Mailbox names from LIST, cached per account."""
+        entry = self._entry(host, email_addr, password)
+        if entry.folders is None:
+            names = []
+            typ, data = mail.list()
+            if typ == "OK":
+                for f in data:
+                    match = _LIST_RE.search(f.decode())
+                    if match:
+                        names.append(match.group("name").strip('"'))
+            entry.folders = names
+        return entry.folders
+
+    def sent_folder(self, host, email_addr, password, mail) -> str:
+        sent_folder = None
+        for name in self.folders(host, email_addr, password, mail):
+            if "Sent" in name and "Trash" not in name:
+                if "Gmail" in name or name == "Sent":
+                    sent_folder = name
+        return sent_folder or "[Gmail]/Sent Mail"
+
+    # -----------------------------
+    # Keepalive
+    # -----------------------------
+    def _ensure_keepalive(self):
+        # Called with self._lock held
+        if self._keepalive is None:
+            self._keepalive = threading.Thread(target=self._keepalive_loop, name="imap-keepalive", daemon=True)
+            self._keepalive.start()
+
+    def _keepalive_loop(self):
+        while True:
+            time.sleep(KEEPALIVE_SECONDS / 2)
+            now = time.monotonic()
+            stale = []
+            with self._lock:
+                for entry in self._accounts.values():
+                    due = [(m, t) for m, t in entry.idle if now - t >= KEEPALIVE_SECONDS / 2]
+                    entry.idle = [(m, t) for m, t in entry.idle if now - t < KEEPALIVE_SECONDS / 2]
+                    stale.append((entry, due))
+            # Ping outside the lock; healthy sessions go back in the pool
+            for entry, due in stale:
+                for mail, _ in due:
+                    try:
+                        mail.noop()
+                        self._checkin(mail, entry)
+                    except Exception:
+                        self._close_all([(mail, 0)])
+
+    @staticmethod
+    def _close_all(sessions):
+        for mail, _ in sessions:
+            try:
+                mail.logout()
+            except Exception:
+                pass
+
+
+POOL = ImapPool()
@@ -0,0 +1,94 @@
+# leader_lease.py
+"""
+Lease-based leader election over MongoDB.
+
+Every worker runs a heartbeat thread that tries to take or renew a TTL'd
+lease document. Whoever holds it is the leader; if the leader dies its
+lease expires and another worker's next heartbeat takes over.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from database import try_acquire_lease, release_lease
+
+logger = logging.getLogger("leader_lease")
+
+# How much sooner than the stored expiry a leader stops trusting its lease
+# (round-trip delay, host clock drift)
+SAFETY_MARGIN_FRACTION = 0.2
+
+
+class LeaderLease:
+    def __init__(self, name: str, ttl_seconds: int = 30):
+        self.name = name
+        self.ttl = ttl_seconds
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._leader = threading.Event()
+        self._deadline = 0.0
+        self._started = False
+        self._stopped = threading.Event()
+        # Held across each renew, so release() never races an in-flight one
+        self._renew_lock = threading.Lock()
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        threading.Thread(target=self._heartbeat, name=f"lease-{self.name}", daemon=True).start()
+
+    def _heartbeat(self):
+        info = {"host": socket.gethostname(), "pid": os.getpid()}
+        while not self._stopped.is_set():
+            with self._renew_lock:
+                if self._stopped.is_set():
+                    break
+                self._renew(info)
+
+            # Renew well before expiry
+            self._stopped.wait(self.ttl / 3)
+
+    def _renew(self, info):
+        # The stored expiry is counted from before the round trip, so the
+        # local deadline must be too, less a margin for clock drift
+        started = time.monotonic()
+        try:
+            acquired = try_acquire_lease(self.name, self.holder, self.ttl, info)
+        except Exception as e:
+            logger.error(f"Lease {self.name} heartbeat failed: {e}")
+            acquired = False
+
+        if acquired:
+            # Local deadline guards against a stalled heartbeat
+            self._deadline = started + self.ttl * (1 - SAFETY_MARGIN_FRACTION)
+            if not self._leader.is_set():
+                logger.info(f"Acquired lease {self.name} as {self.holder}")
+            self._leader.set()
+        else:
+            if self._leader.is_set():
+                logger.warning(f"Lost lease {self.name}")
+            self._leader.clear()
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leader.is_set() and time.monotonic() < self._deadline
+
+    def wait_until_leader(self):
+        while not self.is_leader:
+            time.sleep(1)
+
+    def release(self):
+        """Stop heartbeating and hand the lease over (called on shutdown)."""
+        self._stopped.set()
+        # Wait out a renew in flight, or it could re-take the lease afterwards
+        with self._renew_lock:
+            self._deadline = 0.0
+            if self._leader.is_set():
+                self._leader.clear()
+                try:
+                    release_lease(self.name, self.holder)
+                except Exception as e:
+                    logger.error(f"Lease {self.name} release failed: {e}")
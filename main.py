@@ -6,8 +6,11 @@ import threading
 import logging
 import json
 import time
+import base64
+import binascii
 from datetime import datetime, timezone, timedelta
 from typing import List, Optional
+from urllib.parse import quote
 
 
 
@@ -24,7 +27,10 @@ from passlib.context import CryptContext
 from jose import jwt, JWTError
 from fastapi.security import OAuth2PasswordBearer
 from bson import ObjectId
-from pymongo.errors import DuplicateKeyError
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 
 
 
@@ -32,9 +38,14 @@ from database import (
     mark_customer_read, create_user, get_user_by_email, ensure_customer, 
     email_received, fs, whatsapp_accounts, get_email_accounts, get_whatsapp_accounts, add_email_account,
     get_social_accounts, add_social_account,
-    search_customers, customers, add_note, get_notes, add_tag, get_tags, save_ai_interaction,
-    get_recent_ai_history
+    search_customers, add_note, get_notes, add_tag, get_tags, save_ai_interaction,
+    get_recent_ai_history, record_conversation_message, record_conversation_messages,
+    set_conversation_tags, ensure_customers,
+    search_messages, reserve_inbox_seqs,
+    set_message_status, request_lease_task, take_lease_task, store_attachment, release_attachments, attachment_url
 )
+import database_async as adb
+from search_index import message_terms, query_tokens
 from whatsapp_service import verify_webhook, process_whatsapp_payload, send_whatsapp_text, upload_media, send_whatsapp_media, download_media_bytes
 import social_service
 from email_service import (
@@ -42,9 +53,16 @@ from email_service import (
     send_reply_from_admin_to_customer,
     forward_visitor_message_to_admin
 )
-from gmail_reader import fetch_emails, test_credentials, _strip_quoted_text
+from gmail_reader import (
+    fetch_emails, fetch_account_emails, test_credentials, _strip_quoted_text,
+    sync_watchers, stop_watchers, FolderProgress, account_lock
+)
 from summary_engine import generate_short_summary_txt, generate_detailed_summary_pdf
 import map_router
+from ws_hub import FanoutHub, SocketChannel
+from broadcast_bus import create_bus
+from leader_lease import LeaderLease
+from previews import get_preview, preview_size
 
 try:
     from groq import Groq
@@ -100,11 +118,14 @@ from contextlib import asynccontextmanager
 async def lifespan(app: FastAPI):
     global MAIN_LOOP
     MAIN_LOOP = asyncio.get_running_loop()
-    # Start sync thread
+    BUS.start(MAIN_LOOP)
+    # Start sync thread (it idles unless this worker holds the sync lease)
+    SYNC_LEASE.start()
     thread = threading.Thread(target=gmail_sync_loop, daemon=True)
     thread.start()
     yield
-    # Shutdown logic if needed
+    # Let another worker take over syncing right away
+    SYNC_LEASE.release()
 
 app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -149,9 +170,8 @@ async def meta_webhook_receive(request: Request):
             display_num = data["display_phone_number"]
             
             if business_id:
-                from database import whatsapp_accounts
                 # Persistent record for routing, even if access_token is missing initially
-                whatsapp_accounts.update_one(
+                await adb.whatsapp_accounts.update_one(
                     {"phone_number_id": business_id},
                     {"$set": {
                         "phone_number_id": business_id,
@@ -163,23 +183,26 @@ async def meta_webhook_receive(request: Request):
             # ----------------------------------
 
             attachments_metadata = []
-            if data.get("attachments_info"):
+            # Meta retries webhooks: don't download media for a message we already hold
+            already_stored = data.get("message_id") and await adb.email_received.find_one({"message_id": data["message_id"]}, {"_id": 1})
+            if data.get("attachments_info") and not already_stored:
                  # Fetch token to download media
-                 wa_acc = whatsapp_accounts.find_one({"phone_number_id": business_id})
+                 wa_acc = await adb.whatsapp_accounts.find_one({"phone_number_id": business_id})
                  if wa_acc and wa_acc.get("access_token"):
                      for att in data["attachments_info"]:
                          content, mime = await download_media_bytes(att["whatsapp_id"], wa_acc["access_token"])
                          if content:
-                             f_id = fs.put(content, filename=att["filename"], content_type=mime)
+                             f_id = await run_in_threadpool(store_attachment, content, filename=att["filename"], content_type=mime)
                              attachments_metadata.append({
                                  "id": str(f_id),
-                                 "url": f"/api/attachments/{f_id}",
+                                 "url": attachment_url(f_id, att["filename"]),
                                  "filename": att["filename"],
                                  "content_type": mime,
                                  "size": len(content)
                              })
 
-            insert_message(
+            await run_in_threadpool(
+                insert_message,
                 sender="visitor",
                 text=data["text"],
                 visitor_phone=data["visitor_phone"],
@@ -194,7 +217,8 @@ async def meta_webhook_receive(request: Request):
             # 2. Try Facebook/Instagram
             data = social_service.process_social_payload(payload)
             if data:
-                insert_message(
+                await run_in_threadpool(
+                    insert_message,
                     sender="visitor",
                     text=data["text"],
                     visitor_email=data["sender_id"], # Store sender_id as email/identifier
@@ -259,37 +283,71 @@ MAIN_LOOP = None
 # -----------------------------
 # WebSocket connections
 # -----------------------------
-CONNECTIONS = {}
-ADMIN_CONNECTIONS = set()
+# Per-socket bounded queues + writer tasks (see ws_hub.py)
+HUB = FanoutHub()
+
+def deliver_local(target, key, payload):
+    """Hand a bus event to the sockets held by THIS process."""
+    if target == "admins":
+        HUB.publish_to_admins(payload)
+    else:
+        HUB.publish_to_visitor(key, payload)
+
+# Fans broadcasts out to every worker process (see broadcast_bus.py)
+BUS = create_bus(deliver_local)
 
 def visitor_key(email, guest_id):
     return email or guest_id
 
 
 async def broadcast_to_admins(payload):
-    for ws in ADMIN_CONNECTIONS.copy():
-        try:
-            await ws.send_json(payload)
-        except:
-            ADMIN_CONNECTIONS.discard(ws)
+    BUS.publish("admins", None, payload)
+
+def schedule_broadcast(coro):
+    """Run a broadcast coroutine on the main loop from any thread."""
+    try:
+        if MAIN_LOOP and MAIN_LOOP.is_running():
+            asyncio.run_coroutine_threadsafe(coro, MAIN_LOOP)
+        else:
+            loop = asyncio.get_running_loop()
+            loop.create_task(coro)
+    except RuntimeError:
+        coro.close()
+
+def push_conversation(conv):
+    """Push a full conversation row, stamped with its seq, to every admin dashboard."""
+    if not conv:
+        return
+    schedule_broadcast(broadcast_to_admins({
+        "type": "conversation",
+        "seq": conv["seq"],
+        "conversation": _conversation_row(conv)
+    }))
 
-async def broadcast(email, guest_id, payload):
+async def broadcast(email, guest_id, payload, notify_admins=True):
     key = visitor_key(email, guest_id)
     if not key:
         return
 
-    for ws in CONNECTIONS.get(key, set()).copy():
-        try:
-            await ws.send_json(payload)
-        except:
-            CONNECTIONS[key].discard(ws)
+    BUS.publish("visitor", key, payload)
     
     # Also notify global admins
-    for ws in ADMIN_CONNECTIONS.copy():
-        try:
-            await ws.send_json({"type": "new_message", "payload": payload})
-        except:
-            ADMIN_CONNECTIONS.discard(ws)
+    if notify_admins:
+        BUS.publish("admins", None, {"type": "new_message", "payload": payload})
+
+async def broadcast_batch(payloads, convs):
+    """
+    Announce a batch of ingested messages: each visitor's socket gets its
+    own messages, admins get ONE frame with the messages and changed rows.
+    """
+    for payload in payloads:
+        await broadcast(payload["email"], None, payload, notify_admins=False)
+    BUS.publish("admins", None, {
+        "type": "batch",
+        "seq": max((c["seq"] for c in convs), default=0),
+        "messages": payloads,
+        "conversations": [_conversation_row(c) for c in convs]
+    })
 
 def process_email_background_task(
     visitor_email, text, account_email, html_content, subject, cc, bcc, attachments, custom_message_id
@@ -309,58 +367,38 @@ def process_email_background_task(
         # Update DB
         if custom_message_id:
             msg_id = custom_message_id.strip("<>")
-            email_received.update_one(
-                {"message_id": msg_id},
-                {"$set": {"status": new_status}}
-            )
+            push_conversation(set_message_status(msg_id, new_status))
             
             # Broadcast Status Update
-            if MAIN_LOOP and MAIN_LOOP.is_running():
-                 asyncio.run_coroutine_threadsafe(
-                     broadcast_to_admins({"type": "message_status", "id": msg_id, "status": new_status}),
-                     MAIN_LOOP
-                 )
+            schedule_broadcast(
+                broadcast_to_admins({"type": "message_status", "id": msg_id, "status": new_status})
+            )
 
     except Exception as e:
         logger.error(f"Background Email Task Failed: {e}")
         # Mark as failed
         if custom_message_id:
              msg_id = custom_message_id.strip("<>")
-             email_received.update_one(
-                {"message_id": msg_id},
-                {"$set": {"status": "failed"}}
-            )
+             push_conversation(set_message_status(msg_id, "failed"))
 
 # -----------------------------
 # Insert message (SINGLE SOURCE)
 # -----------------------------
 
 
-def insert_message(sender, text, visitor_email=None, guest_id=None, origin="chat", message_id=None, timestamp=None, attachments=None, account_email=None, html_content=None, subject=None, cc=None, bcc=None, visitor_phone=None, business_number_id=None, in_reply_to=None, sender_name=None):
-    if not visitor_email and not visitor_phone:
-        return
-
-    # Normalize data
-    visitor_email = visitor_email.lower().strip() if visitor_email else None
-    
-    # Identify/Create customer
-    cust = ensure_customer(email=visitor_email, phone=visitor_phone)
-    tb1_id = cust["tb1_id"]
-    
-    # Use phone as identifier if email is missing (for UI consistency)
-    display_identifier = visitor_email or visitor_phone
-    
-    now = timestamp or datetime.now(timezone.utc)
+PREVIEW_LENGTH = 200
 
+def _message_doc(cust, sender, text, visitor_email=None, origin="chat", message_id=None, timestamp=None, attachments=None, account_email=None, html_content=None, subject=None, cc=None, bcc=None, visitor_phone=None, business_number_id=None, in_reply_to=None, sender_name=None):
+    """Build the email_received document for a message from/to 'cust'."""
     doc = {
-        "tb1_id": tb1_id,
-        "email": display_identifier, # Keep as 'email' field for dashboard compatibility, but can be phone
+        "tb1_id": cust["tb1_id"],
+        "email": visitor_email or visitor_phone, # Keep as 'email' field for dashboard compatibility, but can be phone
         "content": text,
         "conversation_id": cust.get("conversation_id"), # Persistent ID
         "sender": sender,
         "sender_name": sender_name,
         "source": origin,   # "chat", "email", "imap", "whatsapp"
-        "timestamp": now,
+        "timestamp": timestamp or datetime.now(timezone.utc),
         "seen_at": None,
         "attachments": attachments or [],
         "account_email": account_email,
@@ -374,32 +412,70 @@ def insert_message(sender, text, visitor_email=None, guest_id=None, origin="chat
     }
     if message_id:
         doc["message_id"] = message_id
+    doc["search_terms"] = message_terms(doc)
+    # Cleaned once here so read paths never re-run the quote stripper
+    doc["text_clean"] = _strip_quoted_text(text) if text else ""
+    doc["preview"] = doc["text_clean"][:PREVIEW_LENGTH]
     
     # Status handling
     doc["status"] = "sent" # Default
     if origin == "email" and sender == "admin":
         doc["status"] = "sending" # Initial state for admin emails
+    return doc
+
+def _duplicate_update(doc):
+    """
+    A message_id we already hold arrived again.
+    1. Stop Future Duplicates: Enforce Idempotency
+    2. Lock Sender: Never update 'sender' or 'source' (origin)
+    3. Update Status/Metadata only
+    """
+    update_fields = {}
+    if doc.get("status") == "sent": 
+         update_fields["status"] = "sent"  # IMAP confirmation updates 'sending' to 'sent'
+    
+    if doc.get("html_content"):
+         update_fields["html_content"] = doc["html_content"]
+
+    # Timestamp is kept as first seen to preserve ordering
+    return update_fields
+
+def _message_payload(doc, cust):
+    """Socket payload announcing a stored message."""
+    return {
+        "sender": doc["sender"],
+        "sender_name": doc.get("sender_name"),
+        "text": doc["content"],
+        "email": doc["email"],
+        "timestamp": doc["timestamp"].isoformat(),
+        "attachments": doc["attachments"],
+        "html_content": doc.get("html_content"),
+        "source": doc["source"],
+        "account_email": doc.get("account_email"),
+        "conversation_id": cust.get("conversation_id")
+    }
+
+def insert_message(sender, text, visitor_email=None, guest_id=None, origin="chat", message_id=None, timestamp=None, attachments=None, account_email=None, html_content=None, subject=None, cc=None, bcc=None, visitor_phone=None, business_number_id=None, in_reply_to=None, sender_name=None):
+    if not visitor_email and not visitor_phone:
+        return
+
+    # Normalize data
+    visitor_email = visitor_email.lower().strip() if visitor_email else None
+    
+    # Identify/Create customer
+    cust = ensure_customer(email=visitor_email, phone=visitor_phone)
 
+    doc = _message_doc(
+        cust, sender, text, visitor_email, origin, message_id, timestamp, attachments, account_email,
+        html_content, subject, cc, bcc, visitor_phone, business_number_id, in_reply_to, sender_name
+    )
 
     try:
         email_received.insert_one(doc)
     except DuplicateKeyError:
-        # 1. Stop Future Duplicates: Enforce Idempotency
-        # 2. Lock Sender: Never update 'sender' or 'source' (origin)
-        # 3. Update Status/Metadata only
-        
-        update_fields = {}
-        if doc.get("status") == "sent": 
-             update_fields["status"] = "sent"  # IMAP confirmation updates 'sending' to 'sent'
-        
-        if doc.get("html_content"):
-             update_fields["html_content"] = doc["html_content"]
-             
-        if doc.get("timestamp"):
-             # Optional: Update timestamp if we prefer the latest sync time? 
-             # Usually keep first. Let's skip timestamp update to preserve ordering.
-             pass
-
+        # Our copy of the attachments is not referenced by any message
+        release_attachments(doc["attachments"])
+        update_fields = _duplicate_update(doc)
         if update_fields:
             email_received.update_one(
                 {"message_id": message_id},
@@ -407,27 +483,93 @@ def insert_message(sender, text, visitor_email=None, guest_id=None, origin="chat
             )
         return
 
-    payload = {
-        "sender": sender,
-        "sender_name": sender_name,
-        "text": text,
-        "email": display_identifier,
-        "timestamp": now.isoformat(),
-        "attachments": attachments or [],
-        "html_content": html_content,
-        "source": origin,
-        "account_email": account_email,
-        "conversation_id": cust.get("conversation_id")
-    }
+    # Keep the inbox summary row in step with the message log
+    conv = record_conversation_message(cust, doc, doc["preview"])
+
+    schedule_broadcast(broadcast(doc["email"], guest_id, _message_payload(doc, cust)))
+    push_conversation(conv)
 
+def insert_messages_bulk(results):
+    """
+    Store a batch of parsed sync results (see gmail_reader) in a handful of
+    round trips: customers resolved together, messages written with one
+    unordered insert_many (known message_ids are skipped), one conversation
+    update per customer and one coalesced socket broadcast.
+    Returns (number of new messages stored, results that failed to store).
+    Duplicates are not failures; anything else in the failed list was not
+    written and must be fetched again.
+    """
+    results = [r for r in results if r.get("visitor")]
+    if not results:
+        return 0, []
+
+    custs = ensure_customers([r["visitor"] for r in results])
+    docs = []
+    sources = []
+    failed = []
+    for r in results:
+        cust = custs.get(r["visitor"].lower().strip())
+        if not cust:
+            failed.append(r)
+            continue
+        sources.append(r)
+        docs.append(_message_doc(
+            cust, r["sender"], r["body"], r["visitor"].lower().strip(), origin=r["source"],
+            message_id=r.get("message_id"), timestamp=r.get("timestamp"), attachments=r.get("attachments"),
+            account_email=r.get("account_email"), html_content=r.get("html_content"),
+            in_reply_to=r.get("in_reply_to"), sender_name=r.get("sender_name")
+        ))
+    if not docs:
+        return 0, failed
+
+    duplicates = set()
+    errors = set()
     try:
-        if MAIN_LOOP and MAIN_LOOP.is_running():
-            asyncio.run_coroutine_threadsafe(broadcast(display_identifier, guest_id, payload), MAIN_LOOP)
-        else:
-            loop = asyncio.get_running_loop()
-            loop.create_task(broadcast(display_identifier, guest_id, payload))
-    except RuntimeError:
-        pass
+        email_received.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        for err in e.details.get("writeErrors", []):
+            if err.get("code") == 11000:
+                duplicates.add(err["index"])
+            else:
+                errors.add(err["index"])
+                logger.error(f"Bulk insert: message {docs[err['index']].get('message_id')} failed: {err.get('errmsg')}")
+    for i in errors:
+        # Not stored: its attachment references would otherwise leak
+        release_attachments(docs[i]["attachments"])
+        failed.append(sources[i])
+
+    updates = []
+    for i in duplicates:
+        release_attachments(docs[i]["attachments"])
+        update_fields = _duplicate_update(docs[i])
+        if update_fields and docs[i].get("message_id"):
+            updates.append(UpdateOne({"message_id": docs[i]["message_id"]}, {"$set": update_fields}))
+    if updates:
+        email_received.bulk_write(updates, ordered=False)
+
+    # Fold new messages into one conversation update per customer
+    by_customer = {}
+    for i, doc in enumerate(docs):
+        if i in duplicates or i in errors:
+            continue
+        by_customer.setdefault(doc["tb1_id"], []).append((doc, doc["preview"]))
+
+    cust_by_id = {c["tb1_id"]: c for c in custs.values()}
+    convs = []
+    payloads = []
+    # One counter round trip per block of customers, not one per customer
+    seqs = reserve_inbox_seqs(len(by_customer))
+    for tb1_id, items in by_customer.items():
+        cust = cust_by_id[tb1_id]
+        conv = record_conversation_messages(cust, items, next(seqs))
+        if conv:
+            convs.append(conv)
+        payloads.extend(_message_payload(doc, cust) for doc, _ in items)
+
+    if payloads:
+        payloads.sort(key=lambda p: p["timestamp"])
+        schedule_broadcast(broadcast_batch(payloads, convs))
+    return len(payloads), failed
 
 # -----------------------------
 # Models
@@ -535,6 +677,11 @@ async def map_dashboard_view(request: Request):
 # -----------------------------
 # ✅ ADMIN INBOX (CUSTOMERS ONLY)
 # -----------------------------
+INBOX_PAGE_SIZE = 50
+INBOX_MAX_PAGE_SIZE = 500
+# Conversations a search or date range narrows the list to; more set search_truncated
+SEARCH_MAX_CONVERSATIONS = 1000
+
 @app.get("/api/admin/messages")
 async def api_admin_messages(
     user: str = Depends(login_required),
@@ -544,40 +691,10 @@ async def api_admin_messages(
     end_date: str | None = None, 
     has_attachments: bool = False, 
     source: str | None = None,
-    since: str | None = None
+    limit: int = INBOX_PAGE_SIZE,
+    after: str | None = None
 ):
-    conversations = {}
-
-    # 1. Identify relevant customers if search is active
-    relevant_tb1_ids = None
-    if search:
-        relevant_tb1_ids = set()
-        regex = {"$regex": search, "$options": "i"}
-        # Find messages matching content OR email
-        matched = email_received.find({
-            "$or": [
-                {"content": regex},
-                {"html_content": regex},
-                {"subject": regex},
-                {"email": regex},
-                {"cc": regex},
-                {"bcc": regex}
-            ]
-        }, {"tb1_id": 1})
-        for m in matched:
-            relevant_tb1_ids.add(m["tb1_id"])
-        
-        # If no matches found, return empty early
-        if not relevant_tb1_ids:
-            return {"messages": [], "server_time": datetime.now(timezone.utc).isoformat()}
-
-    # 2. Fetch latest message for each customer (standard logic)
-    # Fetch ALL sources (chat, imap, email)
-    query = {}
-    if account:
-        query["account_email"] = account.lower().strip()
-    
-    # Date Filtering
+    # Date Filtering (on message timestamps, not just each conversation's latest)
     date_filter = {}
     if start_date:
         try:
@@ -595,110 +712,115 @@ async def api_admin_messages(
         except ValueError:
             pass
 
-    if date_filter:
-        query["timestamp"] = date_filter
+    # 1. Identify relevant customers if search or a date range is active,
+    # from their messages; one extra id tells us the matches were cut off
+    relevant_tb1_ids = None
+    message_filter = {"timestamp": date_filter} if date_filter else None
+    # A query without a single word character filters nothing
+    if search and query_tokens(search):
+        # Prefix match on the indexed terms of body, subject and addresses
+        relevant_tb1_ids = await adb.search_conversation_ids(search, message_filter, limit=SEARCH_MAX_CONVERSATIONS + 1)
+    elif message_filter:
+        relevant_tb1_ids = await adb.conversation_ids_with_messages(message_filter, limit=SEARCH_MAX_CONVERSATIONS + 1)
+
+    search_truncated = relevant_tb1_ids is not None and len(relevant_tb1_ids) > SEARCH_MAX_CONVERSATIONS
+    if search_truncated:
+        relevant_tb1_ids = relevant_tb1_ids[:SEARCH_MAX_CONVERSATIONS]
+
+    # If no matches found, return empty early
+    if relevant_tb1_ids == []:
+        return {"messages": [], "next_cursor": None, "seq": await adb.current_inbox_seq(), "search_truncated": False}
+
+    # 2. Read the materialized conversation rows (one per customer)
+    query = {}
+    if relevant_tb1_ids is not None:
+        query["tb1_id"] = {"$in": relevant_tb1_ids}
+
+    if account:
+        query["accounts"] = account.lower().strip()
     
     # New Filters
     if has_attachments:
-        query["attachments"] = {"$exists": True, "$ne": []}
+        query["has_attachments"] = True
     
     if source and source != "all":
-        query["source"] = source.lower()
+        query["sources"] = source.lower()
     elif not source:
-        # Default for Email Dashboard: exclude whatsapp
-        query["source"] = {"$ne": "whatsapp"}
-        
-    # Ensure customers collection is available
-    from database import customers
+        # Default for Email Dashboard: exclude whatsapp-only conversations
+        query["sources"] = {"$elemMatch": {"$ne": "whatsapp"}}
+
+    # --- KEYSET PAGINATION on (timestamp, tb1_id), newest first ---
+    if after:
+        position = _decode_inbox_cursor(after)
+        if not position:
+            raise HTTPException(status_code=400, detail="Invalid 'after' cursor")
+        after_ts, after_id = position
+        query = {"$and": [query, {"$or": [
+            {"timestamp": {"$lt": after_ts}},
+            {"timestamp": after_ts, "tb1_id": {"$lt": after_id}}
+        ]}]}
+
+    limit = max(1, min(limit, INBOX_MAX_PAGE_SIZE))
+    # Read before the query: the dashboard resumes its socket from here
+    seq = await adb.current_inbox_seq()
+    # Fetch one extra row to know whether another page exists
+    rows = await (
+        adb.conversations.find(query, {"_id": 0})
+        .sort([("timestamp", -1), ("tb1_id", -1)])
+        .limit(limit + 1)
+        .to_list()
+    )
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_inbox_cursor(rows[-1]["timestamp"], rows[-1]["tb1_id"])
+
+    return {
+        "messages": [_conversation_row(c) for c in rows],
+        "next_cursor": next_cursor,
+        "seq": seq,
+        "search_truncated": search_truncated
+    }
+
+
+def _encode_inbox_cursor(ts: datetime, tb1_id: int) -> str:
+    """Opaque 'after' token pointing at the last row of a page."""
+    raw = f"{ts.isoformat()}|{tb1_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_inbox_cursor(cursor: str):
+    """Returns (timestamp, tb1_id), or None if the token is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        ts, tb1_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(ts), int(tb1_id)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
 
-    # --- INCREMENTAL SYNC LOGIC ---
-    if since:
-        try:
-            since_dt = datetime.fromisoformat(since.replace('Z', '+00:00'))
-            # Logic: We need conversations where:
-            # A) A new message arrived > since
-            # OR
-            # B) Customer metadata (tags) updated > since
-            
-            # Find updated customers
-            updated_customers = list(customers.find({"updated_at": {"$gt": since_dt}}, {"tb1_id": 1}))
-            updated_tb1_ids = [c["tb1_id"] for c in updated_customers]
-            
-            # Add timestamp condition to message query OR match updated customers
-            # Complex query: (OriginalQuery AND MessageTimestamp > Since) OR (OriginalQuery AND tb1_id IN updated_ids)
-            
-            # Simpler approach: Fetch messages > since with original filters
-            incremental_query = query.copy()
-            incremental_query["timestamp"] = {"$gt": since_dt}
-            # Note: If date_filter was set, we intersect.
-            if date_filter:
-                incremental_query["timestamp"] = {"$gt": since_dt, **date_filter}
-                
-            # Fetch messages
-            cursor_msgs = list(email_received.find(incremental_query).sort("timestamp", -1))
-            
-            # Also fetch LATEST message for any customer whose tags updated, even if message is old
-            if updated_tb1_ids:
-                # We need the latest message for these customers to return the conversation object
-                # But we must respect original filters (like account, source)
-                meta_query = query.copy()
-                meta_query["tb1_id"] = {"$in": updated_tb1_ids}
-                cursor_meta = list(email_received.find(meta_query).sort("timestamp", -1))
-                
-                # Merge cursors (deduplicate by message_id or processed logic)
-                # We feed 'cursor' to the loop below. 
-                # Let's verify we don't process duplicates in 'conversations' dict logic
-                cursor = cursor_msgs + cursor_meta
-            else:
-                cursor = cursor_msgs
-            
-        except ValueError:
-            # Fallback to full sync if invalid date
-            cursor = email_received.find(query).sort("timestamp", -1)
-    else:
-        # Full Sync
-        # Limit search to avoid hanging if there are thousands of messages
-        # We still fetch ALL unique conversations eventually, but we sort by newest first
-        cursor = email_received.find(query).sort("timestamp", -1)
-
-    for m in cursor:
-        tb1_id = m["tb1_id"]
-
-        # Filter by search results
-        if relevant_tb1_ids is not None:
-             if tb1_id not in relevant_tb1_ids:
-                 continue
-
-        # ONLY keep latest message per customer
-        if tb1_id not in conversations:
-            # OPTIMIZATION: Do not update 'last_seen' writing into DB during a simple list fetch
-            customer = ensure_customer(m["email"], refresh_last_seen=False)
-
-            last_read = customer.get("last_read_at")
-            unread = email_received.count_documents({
-                "tb1_id": tb1_id,
-                "sender": "visitor",
-                **({"timestamp": {"$gt": last_read}} if last_read else {})
-            })
-
-            conversations[tb1_id] = {
-                "conversation_id": customer.get("conversation_id"), # Persistent ID for frontend key
-                "email": m["email"],
-                "name": customer.get("name") or m["email"], # Helpful for display
-                "last_message": _strip_quoted_text(m["content"]) if m.get("content") else "",
-                "timestamp": m["timestamp"].isoformat(),
-                "unread": unread,
-                "attachments": m.get("attachments", []),
-                "html_content": m.get("html_content"),
-                "source": m.get("source", "chat"),
-                "tags": customer.get("tags", [])
-            }
 
+def _conversation_row(c: dict) -> dict:
+    """Shape a conversations document the way the sidebar expects it."""
     return {
-        "messages": list(conversations.values()),
-        "server_time": datetime.now(timezone.utc).isoformat()
+        "conversation_id": c.get("conversation_id"), # Persistent ID for frontend key
+        "email": c["email"],
+        "name": c.get("name") or c["email"], # Helpful for display
+        "last_message": c.get("last_message", ""),
+        "timestamp": c["timestamp"].isoformat(),
+        "unread": c.get("unread", 0),
+        "attachments": c.get("attachments", []),
+        "source": c.get("source", "chat"),
+        "tags": c.get("tags", []),
+        "status": c.get("status"),
+        # Lets the dashboard place pushed rows under its current filters
+        "sources": c.get("sources", []),
+        "accounts": c.get("accounts", []),
+        "has_attachments": c.get("has_attachments", False),
+        "seq": c.get("seq", 0)
     }
 
+
 @app.get("/api/admin/email-accounts")
 async def get_accounts():
     accounts = get_email_accounts()
@@ -788,25 +910,47 @@ async def delete_social_account_api(account_id: str, user: str = Depends(login_r
 
 def run_full_sync():
     try:
-        logging.info("Starting MANUAL full sync...")
-        results = fetch_emails(criteria="ALL")
-        for r in results:
-            insert_message(r["sender"], r["body"], r["visitor"], origin=r["source"], message_id=r.get("message_id"), timestamp=r.get("timestamp"), attachments=r.get("attachments"), account_email=r.get("account_email"), html_content=r.get("html_content"), in_reply_to=r.get("in_reply_to"))
-        logging.info("Manual full sync complete.")
+        logging.info("Starting MANUAL sync...")
+        schedule_broadcast(broadcast_to_admins({"type": "sync_status", "status": "syncing"}))
+        # Incremental: only UIDs above each folder's saved state are fetched
+        stored = ingest_sync_results(fetch_emails(), label="resync")
+        logging.info(f"Manual sync complete ({stored} new messages).")
     except Exception as e:
         logger.error(f"Manual sync error: {e}")
+    finally:
+        schedule_broadcast(broadcast_to_admins({"type": "sync_status", "status": "idle"}))
+
+@app.get("/api/admin/sync-leader")
+async def api_sync_leader(user: str = Depends(login_required)):
+    """Which worker currently holds the mailbox sync lease."""
+    lease = await adb.get_lease(SYNC_LEASE.name) or {}
+    expires_at = lease.get("expires_at")
+    return {
+        "holder": lease.get("holder"),
+        "host": lease.get("host"),
+        "pid": lease.get("pid"),
+        "acquired_at": lease["acquired_at"].isoformat() if lease.get("acquired_at") else None,
+        "expires_at": expires_at.isoformat() if expires_at else None,
+        "active": bool(expires_at and expires_at > datetime.now(timezone.utc)),
+        "this_worker": SYNC_LEASE.holder,
+        "is_this_worker_leader": SYNC_LEASE.is_leader
+    }
 
 @app.post("/api/admin/resync")
-async def api_resync(background_tasks: BackgroundTasks):
-    background_tasks.add_task(run_full_sync)
-    return {"status": "ok", "message": "Sync started in background"}
+async def api_resync():
+    # Only the lease holder's sync loop fetches (a second fetcher would race
+    # its UID checkpoints); it picks the request up within RESYNC_POLL_SECONDS
+    await run_in_threadpool(request_lease_task, SYNC_LEASE.name, "resync")
+    if SYNC_LEASE.is_leader:
+        RESYNC_WAKE.set()
+    return {"status": "ok", "message": "Sync requested from the sync worker"}
 
 
 @app.post("/api/admin/mark-read")
 async def api_mark_read(payload: dict):
     email = payload.get("email")
     if email:
-        mark_customer_read(email)
+        push_conversation(await run_in_threadpool(mark_customer_read, email))
     return {"status": "ok"}
 
 
@@ -848,16 +992,20 @@ async def api_move_conversation(payload: dict, user: str = Depends(login_require
         pipeline.append({"$set": {"tags": {"$setDifference": [{"$ifNull": ["$tags", []]}, ["notifications"]]}}})
         pipeline.append({"$set": {"tags": {"$setUnion": ["$tags", ["inbox"]]}}})
 
-    result = customers.update_one(
+    cust = customers.find_one_and_update(
         {"conversation_id": conversation_id},
-        pipeline
+        pipeline,
+        projection={"tb1_id": 1, "tags": 1},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
+    if cust is None:
         # Fallback: Try identifying by email if conversation_id failed 
         # (This handles race conditions where frontend might have old state)
         # Note: We don't have email in payload currently, so we return error.
         return {"status": "error", "message": "Conversation not found (invalid conversation_id)"}
+
+    push_conversation(set_conversation_tags(cust["tb1_id"], cust.get("tags", [])))
         
     return {"status": "ok"}
 
@@ -865,9 +1013,38 @@ async def api_move_conversation(payload: dict, user: str = Depends(login_require
 # -----------------------------
 # Chat sync (per customer)
 # -----------------------------
+SYNC_MAX_MESSAGES = int(os.environ.get("SYNC_MAX_MESSAGES", "1000"))
+THREAD_PAGE_SIZE = 100
+
+def _encode_thread_cursor(ts: datetime, oid: ObjectId) -> str:
+    """Opaque 'before' token pointing at the oldest message of a page."""
+    raw = f"{ts.isoformat()}|{oid}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_thread_cursor(cursor: str):
+    """Returns (timestamp, ObjectId), or None if the token is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        ts, oid = raw.rsplit("|", 1)
+        return datetime.fromisoformat(ts), ObjectId(oid)
+    except (ValueError, binascii.Error, UnicodeDecodeError, InvalidId):
+        return None
+
+def _clean_text(m: dict) -> str:
+    """Stored text_clean; documents from before it existed are cleaned on the fly."""
+    if "text_clean" in m:
+        return m["text_clean"]
+    return _strip_quoted_text(m["content"]) if m.get("content") else ""
+
 @app.get("/api/sync")
-async def api_sync(email: str, account: str | None = None, start_date: str | None = None, end_date: str | None = None):
+async def api_sync(email: str, account: str | None = None, start_date: str | None = None, end_date: str | None = None, limit: int = THREAD_PAGE_SIZE, before: str | None = None):
+    """
+    One page of a conversation, oldest first: the newest 'limit' messages,
+    or those older than the 'before' cursor. HTML bodies are not included;
+    fetch them per message from /api/messages/{id}/html when has_html.
+    """
     email = email.lower().strip()
+    limit = max(1, min(limit, SYNC_MAX_MESSAGES))
 
     query = {"email": email}
     if account:
@@ -894,33 +1071,72 @@ async def api_sync(email: str, account: str | None = None, start_date: str | Non
     if date_filter:
         query["timestamp"] = date_filter
 
-    msgs = []
-    for m in email_received.find(query):
-        # Referenced Message Lookup
-        referenced_msg = None
-        if m.get("in_reply_to"):
-            # Try to find the message this one replies to
-            # The In-Reply-To ID usually matches a 'message_id' in our DB
-            ref = email_received.find_one({"message_id": m["in_reply_to"]})
-            if ref:
-                referenced_msg = {
-                    "sender": ref.get("sender", "visitor"),
-                    "text": _strip_quoted_text(ref["content"])[:150] + "..." if ref.get("content") and len(ref["content"]) > 150 else _strip_quoted_text(ref.get("content", "")),
-                    "id": ref.get("message_id")
-                }
+    if before:
+        position = _decode_thread_cursor(before)
+        if not position:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        ts, oid = position
+        query = {"$and": [query, {"$or": [
+            {"timestamp": {"$lt": ts}},
+            {"timestamp": ts, "_id": {"$lt": oid}}
+        ]}]}
+
+    # Newest first from the (email, timestamp) index; one extra row tells us if
+    # there is more. Bodies stay in the database: only a has_html flag comes back.
+    cursor = await adb.email_received.aggregate([
+        {"$match": query},
+        {"$sort": {"timestamp": -1, "_id": -1}},
+        {"$limit": limit + 1},
+        {"$set": {
+            "has_html": {"$gt": [{"$strLenBytes": {"$ifNull": ["$html_content", ""]}}, 0]},
+            # The raw body is only needed for documents without text_clean
+            "content": {"$cond": [{"$eq": [{"$type": "$text_clean"}, "missing"]}, "$content", "$$REMOVE"]}
+        }},
+        {"$unset": ["html_content", "search_terms"]}
+    ])
+    docs = await cursor.to_list()
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    next_before = _encode_thread_cursor(docs[-1]["timestamp"], docs[-1]["_id"]) if has_more else None
+    docs.reverse()
+
+    # Referenced Message Lookup: one query for every In-Reply-To in the thread
+    # The In-Reply-To ID usually matches a 'message_id' in our DB
+    ref_ids = list({m["in_reply_to"] for m in docs if m.get("in_reply_to")})
+    refs = {}
+    if ref_ids:
+        async for ref in adb.email_received.find({"message_id": {"$in": ref_ids}}, {"message_id": 1, "sender": 1, "content": 1, "text_clean": 1}):
+            text = _clean_text(ref)
+            refs[ref["message_id"]] = {
+                "sender": ref.get("sender", "visitor"),
+                "text": text[:150] + "..." if len(text) > 150 else text,
+                "id": ref.get("message_id")
+            }
 
+    msgs = []
+    for m in docs:
         msgs.append({
+            "id": str(m["_id"]),
             "sender": m.get("sender", "visitor"),
-            "text": _strip_quoted_text(m["content"]) if m.get("content") else "",
+            "text": _clean_text(m),
             "timestamp": m["timestamp"].isoformat(),
             "attachments": m.get("attachments", []),
-            "html_content": m.get("html_content"),
+            "has_html": m["has_html"],
             "status": m.get("status", "sent"),
-            "referenced_message": referenced_msg
+            "referenced_message": refs.get(m.get("in_reply_to"))
         })
 
-    msgs.sort(key=lambda x: x["timestamp"])
-    return {"messages": msgs}
+    return {"messages": msgs, "next_before": next_before}
+
+@app.get("/api/messages/{msg_id}/html")
+async def api_message_html(msg_id: str, user: str = Depends(login_required)):
+    """HTML body of one message, loaded on demand by the thread view."""
+    if not ObjectId.is_valid(msg_id):
+        raise HTTPException(status_code=404, detail="Message not found")
+    doc = await adb.email_received.find_one({"_id": ObjectId(msg_id)}, {"html_content": 1})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return {"id": msg_id, "html_content": doc.get("html_content")}
 
 @app.get("/api/export")
 async def api_export(email: str):
@@ -957,25 +1173,128 @@ async def api_export(email: str):
         "Content-Disposition": f"attachment; filename={filename}"
     })
 
+ATTACHMENT_READ_SIZE = 256 * 1024
+
+def _byte_range(header: str, size: int):
+    """
+    (start, end) for a single 'bytes=' range, inclusive; None when the
+    header should be ignored; ValueError when it cannot be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None  # Multipart ranges unsupported: send the whole file
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0 or size == 0:
+                raise IndexError
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None  # Malformed: ignore, as RFC 9110 allows
+    except IndexError:
+        raise ValueError(f"unsatisfiable range {header!r}")
+    if start >= size or end < start:
+        raise ValueError(f"unsatisfiable range {header!r}")
+    return start, end
+
+def _iter_grid_range(grid_out, start: int, end: int):
+    """Read [start, end] from a GridFS file; seek() jumps straight to the right chunk."""
+    grid_out.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        data = grid_out.read(min(ATTACHMENT_READ_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+def _grid_file_response(grid_out, request: Request, file_id: str, filename: str | None = None, content_type: str | None = None):
+    """
+    Serve a GridFS file with ETag/304, byte ranges and long-lived caching.
+    'filename'/'content_type' (from the message's attachment entry) override
+    the file's own, which are those of whoever stored the bytes first.
+    """
+    filename = filename or grid_out.filename or file_id
+    # A file id never changes content, so clients may cache it for good
+    tag = getattr(grid_out, "sha256", None) or getattr(grid_out, "md5", None) or f"{file_id}-{grid_out.length}"
+    etag = f'"{tag}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"inline; filename*=UTF-8''{quote(filename, safe='')}"
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    size = grid_out.length
+    media_type = content_type or grid_out.content_type or "application/octet-stream"
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = _byte_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range:
+            start, end = byte_range
+            return StreamingResponse(
+                _iter_grid_range(grid_out, start, end),
+                status_code=206,
+                media_type=media_type,
+                headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)}
+            )
+
+    return StreamingResponse(
+        _iter_grid_range(grid_out, 0, size - 1),
+        media_type=media_type,
+        headers={**headers, "Content-Length": str(size)}
+    )
+
 @app.get("/api/attachments/{file_id}")
-async def get_attachment_file(file_id: str):
+async def get_attachment_file(file_id: str, request: Request, name: str | None = None):
+    if not ObjectId.is_valid(file_id):
+        return Response(status_code=404)
     try:
-        grid_out = fs.get(ObjectId(file_id))
-        return StreamingResponse(
-            grid_out, 
-            media_type=grid_out.content_type or "application/octet-stream",
-            headers={"Content-Disposition": f"inline; filename={grid_out.filename}"}
-        )
+        grid_out = await run_in_threadpool(fs.get, ObjectId(file_id))
     except Exception:
         return Response(status_code=404)
+    # Shared bytes: name and type come from the referencing message's entry
+    entry = await adb.attachment_entry(file_id, name) if name else None
+    if entry:
+        return _grid_file_response(grid_out, request, file_id, entry["filename"], entry.get("content_type"))
+    return _grid_file_response(grid_out, request, file_id)
+
+@app.get("/api/attachments/{file_id}/preview")
+async def get_attachment_preview(file_id: str, request: Request, size: int = 256):
+    """
+    JPEG thumbnail (images) or first-page preview (PDFs), at most 'size'
+    pixels on its longer side. 404 when no preview can be made; clients
+    then fall back to the original.
+    """
+    if not ObjectId.is_valid(file_id):
+        return Response(status_code=404)
+    try:
+        grid_out = await run_in_threadpool(get_preview, ObjectId(file_id), preview_size(size))
+    except Exception:
+        return Response(status_code=404)
+    if grid_out is None:
+        return Response(status_code=404)
+    return _grid_file_response(grid_out, request, str(grid_out._id))
 
 # -----------------------------
 # Visitor sends message
 # -----------------------------
 @app.post("/api/message")
 async def api_message(msg: Message):
-    insert_message("visitor", msg.text, msg.email, msg.guest_id)
-    send_admin_and_customer_notifications(msg.email, msg.text)
+    await run_in_threadpool(insert_message, "visitor", msg.text, msg.email, msg.guest_id)
+    await run_in_threadpool(send_admin_and_customer_notifications, msg.email, msg.text)
     return {"status": "ok"}
 
 # -----------------------------
@@ -1054,13 +1373,13 @@ async def api_reply(
         if files:
             for file in files:
                 content = await file.read()
-                # 1. Save to GridFS
-                file_id = fs.put(content, filename=file.filename, content_type=file.content_type)
+                # 1. Save to GridFS (identical bytes are stored once)
+                file_id = await run_in_threadpool(store_attachment, content, filename=file.filename, content_type=file.content_type)
                 
                 # 2. Metadata for DB
                 attachments_metadata.append({
                     "id": str(file_id),
-                    "url": f"/api/attachments/{file_id}",
+                    "url": attachment_url(file_id, file.filename),
                     "filename": file.filename,
                     "content_type": file.content_type,
                     "size": len(content)
@@ -1077,7 +1396,7 @@ async def api_reply(
         platform = "email"
         if "@" not in visitor_email:
             # Check if it's a social account
-            account = social_accounts.find_one({"account_id": account_email})
+            account = await adb.social_accounts.find_one({"account_id": account_email})
             if account:
                 platform = account.get("platform", "facebook")
             else:
@@ -1096,7 +1415,8 @@ async def api_reply(
                 db_msg_id = db_msg_id[1:-1]
 
             # 3. Insert into DB immediately (Authoritative Source of Truth)
-            insert_message(
+            await run_in_threadpool(
+                insert_message,
                 "admin", 
                 text, 
                 visitor_email,
@@ -1131,7 +1451,8 @@ async def api_reply(
         elif platform == "whatsapp":
             # --- WHATSAPP PATH ---
             # Insert immediately (WhatsApp doesn't have the IMAP duplication issue)
-            insert_message(
+            await run_in_threadpool(
+                insert_message,
                 "admin", 
                 text, 
                 None,
@@ -1153,7 +1474,7 @@ async def api_reply(
             
             if not business_id:
                 # Fallback: Find which business number received the LAST message in this thread
-                last_msg = email_received.find_one({"visitor_phone": visitor_email, "source": "whatsapp"}, sort=[("timestamp", -1)])
+                last_msg = await adb.email_received.find_one({"visitor_phone": visitor_email, "source": "whatsapp"}, sort=[("timestamp", -1)])
                 business_id = last_msg.get("business_number_id") if last_msg else None
             
             if business_id:
@@ -1162,7 +1483,8 @@ async def api_reply(
                 logger.error(f"Could not find business_number_id for WhatsApp reply to {visitor_email}")
         else:
             # --- SOCIAL PATH (Facebook/Instagram) ---
-            insert_message(
+            await run_in_threadpool(
+                insert_message,
                 "admin", text, visitor_email, # visitor_email holds sender_id
                 account_email=account_email,
                 attachments=attachments_metadata,
@@ -1193,6 +1515,32 @@ async def mark_seen(payload: dict):
 # -----------------------------
 # WebSocket
 # -----------------------------
+RESUME_MAX_ROWS = 500
+
+async def handle_admin_socket_message(channel: SocketChannel, text: str):
+    """
+    Admin dashboards send {"type": "resume", "seq": N} after (re)connecting
+    and get every conversation row changed since N, plus a few seqs before
+    it that may have committed late (see conversation_changes_since). If
+    too much was missed they are told to reload the list instead.
+    """
+    try:
+        data = json.loads(text)
+        seq = int(data.get("seq", 0)) if data.get("type") == "resume" else None
+    except (ValueError, TypeError, AttributeError):
+        return
+    if seq is None:
+        return
+
+    changes = await adb.conversation_changes_since(seq, RESUME_MAX_ROWS + 1)
+    if len(changes) > RESUME_MAX_ROWS:
+        await channel.send({"type": "resync", "seq": await adb.current_inbox_seq()})
+        return
+    for conv in changes:
+        if not await channel.send({"type": "conversation", "seq": conv["seq"], "conversation": _conversation_row(conv)}):
+            return  # Client closed for not reading; it will resume again
+    await channel.send({"type": "resumed", "seq": changes[-1]["seq"] if changes else seq})
+
 @app.websocket("/ws")
 async def websocket_handler(
     ws: WebSocket,
@@ -1201,14 +1549,16 @@ async def websocket_handler(
 ):
     if email == "admin_global":
         await ws.accept()
-        ADMIN_CONNECTIONS.add(ws)
+        channel = HUB.add_admin(ws)
         try:
+            await channel.send({"type": "hello", "seq": await adb.current_inbox_seq()})
             while True:
-                await ws.receive_text()
-        except WebSocketDisconnect:
+                await handle_admin_socket_message(channel, await ws.receive_text())
+        except (WebSocketDisconnect, RuntimeError):
+            # RuntimeError: the hub closed us for being too slow
             pass
         finally:
-            ADMIN_CONNECTIONS.discard(ws)
+            HUB.remove_admin(channel)
         return
 
     key = visitor_key(email, guest_id)
@@ -1217,15 +1567,21 @@ async def websocket_handler(
         return
 
     await ws.accept()
-    CONNECTIONS.setdefault(key, set()).add(ws)
+    channel = HUB.add_visitor(key, ws)
 
     try:
         while True:
             await ws.receive_text()
-    except WebSocketDisconnect:
+    except (WebSocketDisconnect, RuntimeError):
         pass
     finally:
-        CONNECTIONS[key].discard(ws)
+        HUB.remove_visitor(key, channel)
+
+
+@app.get("/api/admin/ws-stats")
+async def api_ws_stats(user: str = Depends(login_required)):
+    """Fan-out health: connections, queue depth and dropped frames."""
+    return HUB.snapshot()
 
 
 def get_emails_tool(query: str = None, start_date: str = None, end_date: str = None, account: str = None):
@@ -1252,13 +1608,9 @@ def get_emails_tool(query: str = None, start_date: str = None, end_date: str = N
         filter_query["timestamp"] = date_filter
 
     if query:
-        filter_query["$or"] = [
-            {"content": {"$regex": query, "$options": "i"}},
-            {"email": {"$regex": query, "$options": "i"}},
-            {"subject": {"$regex": query, "$options": "i"}}
-        ]
-
-    msgs = list(email_received.find(filter_query).sort("timestamp", -1).limit(10))
+        msgs = search_messages(query, filter_query, limit=10)
+    else:
+        msgs = list(email_received.find(filter_query, {"search_terms": 0}).sort("timestamp", -1).limit(10))
     results = []
     for m in msgs:
         results.append({
@@ -1322,11 +1674,9 @@ def draft_reply_tool(email: str, body: str):
 
 def get_inbox_stats_tool():
     """Get unread message counts across all email and WhatsApp sources."""
-    from database import get_unread_count, get_email_accounts, get_whatsapp_accounts
-    stats = {"unread_total": 0, "email_accounts": [], "whatsapp_accounts": []}
-    all_customers = list(customers.find({"last_read_at": {"$exists": True}}))
-    for cust in all_customers:
-        stats["unread_total"] += get_unread_count(cust["tb1_id"])
+    from database import get_unread_totals, get_email_accounts, get_whatsapp_accounts
+    unread = get_unread_totals()
+    stats = {"unread_total": unread["messages"], "unread_conversations": unread["conversations"]}
     stats["email_accounts"] = [a["email"] for a in get_email_accounts()]
     stats["whatsapp_accounts"] = [a["display_phone_number"] for a in get_whatsapp_accounts()]
     return stats
@@ -1501,7 +1851,7 @@ def get_customer_details_tool(email: str):
 def add_customer_tag_tool(email: str, tag: str):
     """Add a tag to a customer."""
     from database import add_tag
-    add_tag(email, tag)
+    push_conversation(add_tag(email, tag))
     return f"Tag added: {tag}"
 
 
@@ -2355,64 +2705,125 @@ async def transcribe_live(websocket: WebSocket):
 # -----------------------------
 # Gmail sync (SAFE)
 # -----------------------------
+# Exactly one worker polls the mailboxes; see leader_lease.py
+SYNC_LEASE = LeaderLease("gmail_sync", ttl_seconds=int(os.environ.get("SYNC_LEASE_TTL", "30")))
+
+SENT_SWEEP_SECONDS = int(os.environ.get("SENT_SWEEP_SECONDS", "60"))
+# How often the leader checks for resyncs requested on other workers
+RESYNC_POLL_SECONDS = 5
+# Set by a resync request on the leader itself so the sweep loop runs it now
+RESYNC_WAKE = threading.Event()
+
+INGEST_BATCH = int(os.environ.get("INGEST_BATCH", "200"))
+
+def ingest_sync_results(results, label="sync"):
+    """
+    Store messages from a (streaming) fetch in chunks of INGEST_BATCH as
+    they arrive, reporting progress to admin dashboards after each chunk.
+    Folder UID checkpoints in the stream are saved only after the messages
+    ahead of them are stored, and never past one that failed; "saved"
+    events (see fetch_emails) are set once that has happened.
+    Returns the number of new messages stored.
+    """
+    results = iter(results)
+    progress = FolderProgress()
+    scanned = stored = 0
+    while True:
+        if not SYNC_LEASE.is_leader:
+            # The new leader resumes from the last saved checkpoint
+            logger.warning(f"Sync lease lost; abandoning {label}")
+            break
+        chunk = []
+        for r in results:
+            chunk.append(r)
+            # The account's fetch waits for this event: store the chunk now
+            if len(chunk) >= INGEST_BATCH or "saved" in r:
+                break
+        if not chunk:
+            break
+        messages = [r for r in chunk if "checkpoint" not in r and "saved" not in r]
+        # Gmail replies ALSO mapped to customer
+        new, failed = insert_messages_bulk(messages)
+        progress.failed(failed)
+        for r in chunk:
+            if "checkpoint" in r:
+                progress.save(r["checkpoint"])
+            elif "saved" in r:
+                r["saved"].set()
+        stored += new
+        scanned += len(messages)
+        schedule_broadcast(broadcast_to_admins({
+            "type": "sync_progress", "label": label, "scanned": scanned, "stored": stored
+        }))
+    return stored
+
+def sync_inbox_now(account_config):
+    """IDLE callback: the server reported new INBOX mail for this account."""
+    if not SYNC_LEASE.is_leader:
+        return  # Watchers are being stopped; the leader's own watcher covers it
+    schedule_broadcast(broadcast_to_admins({"type": "sync_status", "status": "syncing"}))
+    try:
+        # Waits only for a fetch of this same account (e.g. a resync)
+        with account_lock(account_config["email"]):
+            ingest_sync_results(fetch_account_emails(account_config, scan_sent_folder=False))
+    except Exception as e:
+        logger.error(f"Inbox sync error for {account_config.get('email')}: {e}")
+    finally:
+        schedule_broadcast(broadcast_to_admins({"type": "sync_status", "status": "idle"}))
+
+def wait_for_next_sweep():
+    """
+    Sleep until the next Sent sweep, running resyncs requested meanwhile.
+    Returns early once the sync lease is lost.
+    """
+    deadline = time.monotonic() + SENT_SWEEP_SECONDS
+    while time.monotonic() < deadline:
+        if not SYNC_LEASE.is_leader:
+            return
+        try:
+            if SYNC_LEASE.is_leader and take_lease_task(SYNC_LEASE.name, "resync"):
+                run_full_sync()
+        except Exception as e:
+            logger.error(f"Resync request check failed: {e}")
+        RESYNC_WAKE.wait(RESYNC_POLL_SECONDS)
+        RESYNC_WAKE.clear()
+
 def gmail_sync_loop():
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    
-    sync_counter = 0
 
-    # 1. Backfill history (fetch ALL) - run once on startup
+    SYNC_LEASE.wait_until_leader()
+
+    # 1. Catch up on startup: folders with saved UID state only fetch what
+    # arrived since; new folders backfill IMAP_INITIAL_SYNC_DAYS of history
     try:
         logging.info("Starting initial email backfill...")
-        # Optimization: Only backfill last 7 days initially to avoid hanging on massive inboxes
-        seven_days_ago = (datetime.now() - timedelta(days=7)).strftime("%d-%b-%Y")
-        initial_emails = fetch_emails(criteria=f'(SINCE "{seven_days_ago}")')
-        for r in initial_emails:
-            insert_message(r["sender"], r["body"], r["visitor"], origin=r["source"], message_id=r.get("message_id"), timestamp=r.get("timestamp"), attachments=r.get("attachments"), account_email=r.get("account_email"), html_content=r.get("html_content"), in_reply_to=r.get("in_reply_to"), sender_name=r.get("sender_name"))
-        logging.info("Initial backfill complete.")
+        stored = ingest_sync_results(fetch_emails(), label="backfill")
+        logging.info(f"Initial backfill complete ({stored} new messages).")
     except Exception as e:
         logger.error(f"Backfill error: {e}")
 
+    # 2. Continuous sync: one IDLE connection per account pushes INBOX
+    # changes (see MailboxWatcher); Sent folders are swept periodically
+    watchers = {}
     while True:
+        if not SYNC_LEASE.is_leader:
+            logger.warning("Sync lease lost; stopping mailbox watchers")
+            stop_watchers(watchers)
+            SYNC_LEASE.wait_until_leader()
+
         try:
-            # Broadcast syncing status
-            if MAIN_LOOP:
-                asyncio.run_coroutine_threadsafe(
-                    broadcast_to_admins({"type": "sync_status", "status": "syncing"}), 
-                    MAIN_LOOP
-                )
+            # Picks up added/removed accounts and restarts dead watchers
+            sync_watchers(watchers, sync_inbox_now)
 
-            # 2. Continuous sync (fetch UNSEEN)
-            # Scan Sent folder only every 6th iteration (approx 60s) to reduce load
-            should_scan_sent = (sync_counter % 6 == 0)
-            replies = fetch_emails(criteria="UNSEEN", scan_sent_folder=should_scan_sent)
-            
-            sync_counter += 1
-
-            for r in replies:
-                sender = r["sender"]
-                body = r["body"]
-                email = r["visitor"]
-
-                # Gmail replies ALSO mapped to customer
-                insert_message(sender, body, email, origin=r["source"], message_id=r.get("message_id"), timestamp=r.get("timestamp"), attachments=r.get("attachments"), account_email=r.get("account_email"), html_content=r.get("html_content"), in_reply_to=r.get("in_reply_to"), sender_name=r.get("sender_name"))
-
-                # if sender == "visitor":
-                #    forward_visitor_message_to_admin(email, body)
-                # else:
-                #    send_reply_from_admin_to_customer(email, body)
-
-            # Broadcast idle status
-            if MAIN_LOOP:
-                asyncio.run_coroutine_threadsafe(
-                    broadcast_to_admins({"type": "sync_status", "status": "idle"}), 
-                    MAIN_LOOP
-                )
+            schedule_broadcast(broadcast_to_admins({"type": "sync_status", "status": "syncing"}))
+            ingest_sync_results(fetch_emails(scan_sent_folder=True, scan_inbox=False))
+            schedule_broadcast(broadcast_to_admins({"type": "sync_status", "status": "idle"}))
 
         except Exception as e:
             logger.error(f"Gmail sync error: {e}")
 
-        time.sleep(10) # 10 seconds as per plan
+        wait_for_next_sweep()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,91 @@
+import hashlib
+import re
+from bson import ObjectId
+from pymongo import UpdateOne
+from database import fs, fs_files, email_received, conversations, attachment_url
+
+BATCH_SIZE = 500
+_ATTACHMENT_URL_RE = re.compile(r"/api/attachments/([0-9a-f]{24})")
+
+def _attachment_id(att):
+    return att.get("file_id") or att.get("id")
+
+def _repoint(att, duplicates):
+    """Rewrite one attachment entry to its canonical file, if it was a duplicate."""
+    canon = duplicates.get(_attachment_id(att))
+    if not canon:
+        return att, False
+    att = dict(att)
+    for key in ("file_id", "id"):
+        if key in att:
+            att[key] = canon
+    att["url"] = attachment_url(canon, att.get("filename"))
+    return att, True
+
+def _repoint_html(html, duplicates):
+    """Rewrite /api/attachments/<dup> URLs (inline CID images, see gmail_reader._parse_body)."""
+    if not html or "/api/attachments/" not in html:
+        return html, False
+    new_html = _ATTACHMENT_URL_RE.sub(lambda m: f"/api/attachments/{duplicates.get(m.group(1), m.group(1))}", html)
+    return new_html, new_html != html
+
+def _rewrite(collection, duplicates, label):
+    ops = []
+    count = 0
+    for doc in collection.find({"attachments.0": {"$exists": True}}, {"attachments": 1, "html_content": 1}):
+        changed = False
+        atts = []
+        for att in doc["attachments"]:
+            att, moved = _repoint(att, duplicates)
+            atts.append(att)
+            changed |= moved
+        update = {"attachments": atts}
+        html, html_moved = _repoint_html(doc.get("html_content"), duplicates)
+        if html_moved:
+            update["html_content"] = html
+        if changed or html_moved:
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+        if len(ops) >= BATCH_SIZE:
+            collection.bulk_write(ops, ordered=False)
+            count += len(ops)
+            ops = []
+    if ops:
+        collection.bulk_write(ops, ordered=False)
+        count += len(ops)
+    print(f"Re-pointed attachments on {count} {label}.")
+
+def dedupe_attachments():
+    print("Hashing stored files...")
+    canonical = {f["sha256"]: str(f["_id"]) for f in fs_files.find({"sha256": {"$exists": True}}, {"sha256": 1})}
+    duplicates = {}
+    # Generated previews are not attachments
+    for f in fs_files.find({"sha256": {"$exists": False}, "preview_of": {"$exists": False}}, {"_id": 1}):
+        sha = hashlib.sha256(fs.get(f["_id"]).read()).hexdigest()
+        if sha in canonical:
+            duplicates[str(f["_id"])] = canonical[sha]
+        else:
+            fs_files.update_one({"_id": f["_id"]}, {"$set": {"sha256": sha}})
+            canonical[sha] = str(f["_id"])
+    print(f"Found {len(duplicates)} duplicate files.")
+
+    _rewrite(email_received, duplicates, "messages")
+    _rewrite(conversations, duplicates, "conversations")
+    for dup_id in duplicates:
+        fs.delete(ObjectId(dup_id))
+
+    print("Recounting references...")
+    counts = {}
+    for doc in email_received.find({"attachments.0": {"$exists": True}}, {"attachments": 1}):
+        for att in doc["attachments"]:
+            counts[_attachment_id(att)] = counts.get(_attachment_id(att), 0) + 1
+    ops = [
+        # Files nothing points at keep one reference rather than being deleted here
+        UpdateOne({"_id": f["_id"]}, {"$set": {"refcount": counts.get(str(f["_id"]), 0) or 1}})
+        for f in fs_files.find({"preview_of": {"$exists": False}}, {"_id": 1})
+    ]
+    for i in range(0, len(ops), BATCH_SIZE):
+        fs_files.bulk_write(ops[i:i + BATCH_SIZE], ordered=False)
+    print(f"Done. Freed {len(duplicates)} files.")
+
+if __name__ == "__main__":
+    dedupe_attachments()
@@ -0,0 +1,70 @@
+from database import customers, email_received, conversations, next_inbox_seq
+from gmail_reader import _strip_quoted_text
+from datetime import datetime, timezone
+
+def rebuild_conversations():
+    """Backfill the 'conversations' collection from the existing message log."""
+    print("Rebuilding conversation summaries from email_received...")
+    pipeline = [
+        {"$sort": {"timestamp": -1}},
+        {"$group": {
+            "_id": "$tb1_id",
+            "email": {"$first": "$email"},
+            "content": {"$first": "$content"},
+            "preview": {"$first": "$preview"},
+            "attachments": {"$first": "$attachments"},
+            "source": {"$first": "$source"},
+            "account_email": {"$first": "$account_email"},
+            "message_id": {"$first": "$message_id"},
+            "status": {"$first": "$status"},
+            "timestamp": {"$first": "$timestamp"},
+            "sources": {"$addToSet": "$source"},
+            "accounts": {"$addToSet": {"$toLower": {"$ifNull": ["$account_email", ""]}}},
+            "has_attachments": {"$max": {"$gt": [{"$size": {"$ifNull": ["$attachments", []]}}, 0]}}
+        }}
+    ]
+
+    count = 0
+    for g in email_received.aggregate(pipeline, allowDiskUse=True):
+        cust = customers.find_one({"tb1_id": g["_id"]})
+        if not cust:
+            continue
+
+        last_read = cust.get("last_read_at")
+        unread = email_received.count_documents({
+            "tb1_id": g["_id"],
+            "sender": "visitor",
+            **({"timestamp": {"$gt": last_read}} if last_read else {})
+        })
+
+        conversations.update_one(
+            {"tb1_id": g["_id"]},
+            {"$set": {
+                "tb1_id": g["_id"],
+                "conversation_id": cust.get("conversation_id"),
+                "email": g["email"],
+                "name": cust.get("name") or g["email"],
+                "tags": cust.get("tags", []),
+                "last_message": g["preview"] if g.get("preview") is not None else (_strip_quoted_text(g["content"])[:200] if g.get("content") else ""),
+                "attachments": g.get("attachments") or [],
+                "source": g.get("source", "chat"),
+                "account_email": g.get("account_email"),
+                "last_message_id": g.get("message_id"),
+                "status": g.get("status"),
+                "timestamp": g["timestamp"],
+                "sources": g["sources"],
+                "accounts": [a for a in g["accounts"] if a],
+                "has_attachments": g["has_attachments"],
+                "unread": unread,
+                "last_read_at": last_read,
+                "updated_at": datetime.now(timezone.utc),
+                "seq": next_inbox_seq()
+            }},
+            upsert=True
+        )
+        count += 1
+
+    print(f"Rebuilt {count} conversations.")
+
+if __name__ == "__main__":
+    rebuild_conversations()
@@ -0,0 +1,34 @@
+import sys
+
+from pymongo import UpdateOne
+from database import customers, email_received
+from search_index import message_terms, customer_terms
+
+BATCH_SIZE = 500
+
+def _backfill(collection, build_terms, label, rebuild=False):
+    print(f"Indexing {label}...")
+    ops = []
+    count = 0
+    for doc in collection.find({} if rebuild else {"search_terms": {"$exists": False}}):
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"search_terms": build_terms(doc)}}))
+        if len(ops) >= BATCH_SIZE:
+            collection.bulk_write(ops, ordered=False)
+            count += len(ops)
+            ops = []
+    if ops:
+        collection.bulk_write(ops, ordered=False)
+        count += len(ops)
+    print(f"Indexed {count} {label}.")
+
+def backfill_search_terms(rebuild_customers=False):
+    """
+    Index documents that have no terms yet. With rebuild_customers, every
+    customer is re-indexed, picking up names, emails or phones edited
+    outside the app.
+    """
+    _backfill(email_received, message_terms, "messages")
+    _backfill(customers, customer_terms, "customers", rebuild=rebuild_customers)
+
+if __name__ == "__main__":
+    backfill_search_terms(rebuild_customers="--rebuild-customers" in sys.argv)
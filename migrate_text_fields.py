@@ -0,0 +1,29 @@
+from pymongo import UpdateOne
+from database import email_received
+from gmail_reader import _strip_quoted_text
+
+BATCH_SIZE = 500
+PREVIEW_LENGTH = 200
+
+def backfill_text_fields():
+    """Store text_clean/preview on messages ingested before they were computed at insert time."""
+    print("Cleaning message bodies...")
+    ops = []
+    count = 0
+    for doc in email_received.find({"text_clean": {"$exists": False}}, {"content": 1}):
+        text_clean = _strip_quoted_text(doc["content"]) if doc.get("content") else ""
+        ops.append(UpdateOne(
+            {"_id": doc["_id"]},
+            {"$set": {"text_clean": text_clean, "preview": text_clean[:PREVIEW_LENGTH]}}
+        ))
+        if len(ops) >= BATCH_SIZE:
+            email_received.bulk_write(ops, ordered=False)
+            count += len(ops)
+            ops = []
+    if ops:
+        email_received.bulk_write(ops, ordered=False)
+        count += len(ops)
+    print(f"Updated {count} messages.")
+
+if __name__ == "__main__":
+    backfill_text_fields()
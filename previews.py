@@ -0,0 +1,118 @@
+# previews.py
+"""
+Thumbnails for image attachments and first-page previews for PDFs.
+
+A preview is rendered the first time it is requested and stored in GridFS
+next to the original (fields 'preview_of' and 'preview_size'), so each
+size is only ever made once. Attachment files never change content; when
+one is deleted its previews go with it (see database.release_attachments).
+
+Needs Pillow; PDF previews also need PyMuPDF. Without them nothing is
+previewable and clients fall back to the original file.
+"""
+import io
+import logging
+
+from bson import ObjectId
+from gridfs.errors import FileExists
+
+from database import fs, fs_files, fs_chunks
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+logger = logging.getLogger("previews")
+
+# Requested sizes snap to these, which bounds how many copies can pile up
+PREVIEW_SIZES = (128, 256, 512, 1024)
+MAX_SOURCE_BYTES = 40 * 1024 * 1024
+JPEG_QUALITY = 80
+
+
+def preview_size(requested: int) -> int:
+    """Smallest supported size that is at least 'requested'."""
+    for size in PREVIEW_SIZES:
+        if size >= requested:
+            return size
+    return PREVIEW_SIZES[-1]
+
+
+def can_preview(content_type: str | None) -> bool:
+    if Image is None or not content_type:
+        return False
+    if content_type == "application/pdf":
+        return fitz is not None
+    # SVG is not raster; browsers render it fine at any size anyway
+    return content_type.startswith("image/") and content_type != "image/svg+xml"
+
+
+def _render(data: bytes, content_type: str, size: int) -> bytes:
+    if content_type == "application/pdf":
+        with fitz.open(stream=data, filetype="pdf") as doc:
+            page = doc.load_page(0)
+            zoom = size / max(page.rect.width, page.rect.height)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            img = Image.open(io.BytesIO(pix.tobytes("png")))
+    else:
+        img = Image.open(io.BytesIO(data))
+        img.draft("RGB", (size, size))  # JPEG: decode at reduced scale
+        img = ImageOps.exif_transpose(img)  # Phone photos carry rotation in EXIF
+
+    img.thumbnail((size, size))
+    if img.mode in ("RGBA", "LA", "P"):
+        # Flatten transparency onto white rather than JPEG's black
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, "white")
+        background.paste(img, mask=img.getchannel("A"))
+        img = background
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def _cached(file_id: ObjectId, size: int):
+    doc = fs_files.find_one({"preview_of": file_id, "preview_size": size}, {"_id": 1})
+    return fs.get(doc["_id"]) if doc else None
+
+
+def get_preview(file_id: ObjectId, size: int):
+    """
+    GridOut of the 'size' preview of an attachment, rendering and storing
+    it on first use. None if the file cannot be previewed. Blocking: call
+    from a thread.
+    """
+    cached = _cached(file_id, size)
+    if cached:
+        return cached
+
+    source = fs.get(file_id)
+    content_type = source.content_type
+    if not can_preview(content_type) or source.length > MAX_SOURCE_BYTES:
+        return None
+    try:
+        data = _render(source.read(), content_type, size)
+    except Exception as e:
+        logger.warning(f"Could not preview attachment {file_id}: {e}")
+        return None
+
+    preview_id = ObjectId()
+    try:
+        fs.put(
+            data, _id=preview_id, filename=f"{source.filename}.{size}.jpg",
+            content_type="image/jpeg", preview_of=file_id, preview_size=size
+        )
+    except FileExists:
+        # Rendered concurrently (the unique index clash surfaces as
+        # FileExists): drop our orphaned chunks, keep theirs
+        fs_chunks.delete_many({"files_id": preview_id})
+        return _cached(file_id, size)
+    return fs.get(preview_id)
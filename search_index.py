@@ -0,0 +1,97 @@
+# search_index.py
+"""
+Term extraction for inbox search.
+
+Messages and customers carry a 'search_terms' array (multikey indexed).
+Queries match every query token as a prefix of some stored term, which an
+anchored regex can answer straight from the index instead of scanning
+content/html bodies.
+"""
+import html
+import re
+
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 40
+MAX_TERMS_PER_DOC = 2000
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_ADDRESS_RE = re.compile(r"[\w.%+-]+@[\w.-]+\.\w+", re.UNICODE)
+_SCRIPT_STYLE_RE = re.compile(r"<(script|style)\b.*?</\1>", re.IGNORECASE | re.DOTALL)
+_TAG_RE = re.compile(r"<[^>]+>")
+
+
+def html_to_text(markup: str | None) -> str:
+    """Cheap tag stripper, good enough for indexing."""
+    if not markup:
+        return ""
+    text = _SCRIPT_STYLE_RE.sub(" ", markup)
+    text = _TAG_RE.sub(" ", text)
+    return html.unescape(text)
+
+
+def tokenize(text: str | None) -> list[str]:
+    """Lowercased word tokens in order of appearance (duplicates kept)."""
+    if not text:
+        return []
+    return [
+        t for t in _WORD_RE.findall(text.lower())
+        if MIN_TERM_LENGTH <= len(t) <= MAX_TERM_LENGTH
+    ]
+
+
+def _collect(*texts) -> list[str]:
+    terms = {}
+    for text in texts:
+        if not text:
+            continue
+        # Whole addresses too, so exact address queries rank first
+        for addr in _ADDRESS_RE.findall(text.lower()):
+            if len(addr) <= MAX_TERM_LENGTH * 2:
+                terms.setdefault(addr, None)
+        for t in tokenize(text):
+            terms.setdefault(t, None)
+            if len(terms) >= MAX_TERMS_PER_DOC:
+                return list(terms)
+    return list(terms)
+
+
+def message_terms(doc: dict) -> list[str]:
+    """Terms for an email_received document: subject, addresses, then body."""
+    body = doc.get("content") or html_to_text(doc.get("html_content"))
+    return _collect(
+        doc.get("subject"),
+        doc.get("email"),
+        " ".join(doc.get("cc") or []),
+        " ".join(doc.get("bcc") or []),
+        doc.get("sender_name"),
+        body,
+    )
+
+
+def customer_terms(doc: dict) -> list[str]:
+    """Terms for a customers document: name, email and phone."""
+    phone = doc.get("phone") or ""
+    digits = re.sub(r"\D", "", phone)
+    return _collect(doc.get("name"), doc.get("cust_email"), phone, digits)
+
+
+def query_tokens(query: str | None) -> list[str]:
+    """
+    Distinct query tokens; each must prefix-match a stored term. Unlike
+    stored terms they may be a single character ("a" finds "alice").
+    """
+    if not query:
+        return []
+    return list(dict.fromkeys(t for t in _WORD_RE.findall(query.lower()) if len(t) <= MAX_TERM_LENGTH))
+
+
+def terms_filter(tokens: list[str]) -> dict:
+    """Mongo filter requiring every token as a prefix of some 'search_terms' entry."""
+    return {"$and": [
+        {"search_terms": {"$regex": f"^{re.escape(t)}"}} for t in tokens
+    ]}
+
+
+def exact_hits(tokens: list[str]) -> dict:
+    """Aggregation expression counting tokens that matched a term exactly."""
+    return {"$size": {"$setIntersection": [{"$ifNull": ["$search_terms", []]}, tokens]}}
@@ -0,0 +1,228 @@
+# smtp_pool.py
+"""
+Reusable authenticated SMTP sessions and the delivery workers in front of
+them.
+
+Opening a session costs a TCP connect, STARTTLS and AUTH. The pool keeps
+logged-in sessions per sender account, checks one that sat idle with NOOP
+before reusing it, and retries on a fresh session when a reused one turns
+out to have been dropped by the server. An account whose logins fail is
+backed off exponentially.
+
+Deliveries run on a small worker pool, and each account has at most
+SMTP_PER_ACCOUNT sends in flight, so one busy mailbox cannot take every
+worker or trip the provider's concurrent-connection limit. Sends over an
+account's limit wait in that account's queue, not on a worker.
+"""
+import logging
+import os
+import smtplib
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger("smtp_pool")
+
+SMTP_HOST = os.environ.get("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
+SMTP_TIMEOUT = int(os.environ.get("SMTP_TIMEOUT", "60"))
+# Concurrent sends (and so pooled sessions) per sender account
+PER_ACCOUNT = int(os.environ.get("SMTP_PER_ACCOUNT", "2"))
+WORKERS = int(os.environ.get("SMTP_WORKERS", "8"))
+# Sessions idle longer than this are NOOP-checked before reuse...
+NOOP_AFTER_SECONDS = 30
+# ...and past this the server has most likely dropped them already
+MAX_IDLE_SECONDS = 240
+# Gmail closes a session after ~100 messages; rotate before that
+MAX_MESSAGES_PER_SESSION = 90
+MAX_BACKOFF_SECONDS = 300
+
+
+class _Account:
+    """Pool state for one sender."""
+
+    def __init__(self, password):
+        self.password = password
+        self.idle = []              # [(SMTP, messages sent on it, last_used monotonic)]
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+class _SendQueue:
+    """Deliveries of one sender: how many hold a worker, and those waiting."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.waiting = deque()      # [(Future, fn, args, kwargs)]
+
+
+class _Session(smtplib.SMTP):
+    """SMTP session that notes when a message reached the DATA stage."""
+
+    in_data = False
+
+    def data(self, msg):
+        self.in_data = True
+        return super().data(msg)
+
+
+class SmtpPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._accounts: dict[str, _Account] = {}
+        self._queues: dict[str, _SendQueue] = {}
+        self._workers = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="smtp-send")
+
+    # -----------------------------
+    # Sessions
+    # -----------------------------
+    def _entry(self, email_addr, password) -> _Account:
+        key = email_addr.lower()
+        with self._lock:
+            entry = self._accounts.get(key)
+            if entry is None or entry.password != password:
+                # New account or changed password: old sessions are stale
+                if entry is not None:
+                    self._close_all(entry.idle)
+                entry = self._accounts[key] = _Account(password)
+            return entry
+
+    def _connect(self, email_addr, password, entry):
+        now = time.monotonic()
+        with self._lock:
+            retry_at = entry.retry_at
+        if now < retry_at:
+            raise smtplib.SMTPConnectError(
+                421, f"{email_addr}: reconnect backoff ({int(retry_at - now)}s left)"
+            )
+        try:
+            smtp = _Session(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            smtp.starttls()
+            smtp.login(email_addr, password)
+        except Exception:
+            with self._lock:
+                entry.failures += 1
+                entry.retry_at = time.monotonic() + min(2 ** entry.failures, MAX_BACKOFF_SECONDS)
+            raise
+        with self._lock:
+            entry.failures = 0
+            entry.retry_at = 0.0
+        return smtp
+
+    def _checkout(self, email_addr, password, entry):
+        """A usable session and how many messages it has sent (0 = fresh)."""
+        while True:
+            with self._lock:
+                if not entry.idle:
+                    break
+                smtp, sent, last_used = entry.idle.pop()
+            idle_for = time.monotonic() - last_used
+            if idle_for < NOOP_AFTER_SECONDS:
+                return smtp, sent
+            if idle_for < MAX_IDLE_SECONDS:
+                try:
+                    if smtp.noop()[0] == 250:
+                        return smtp, sent
+                except smtplib.SMTPException:
+                    pass
+            self._close_all([(smtp, 0, 0)])
+        return self._connect(email_addr, password, entry), 0
+
+    def _checkin(self, smtp, sent, entry):
+        with self._lock:
+            if sent < MAX_MESSAGES_PER_SESSION and len(entry.idle) < PER_ACCOUNT:
+                entry.idle.append((smtp, sent, time.monotonic()))
+                return
+        self._close_all([(smtp, 0, 0)])
+
+    # -----------------------------
+    # Delivery
+    # -----------------------------
+    def send(self, email_addr, password, recipients, message: str):
+        """
+        Deliver one message as 'email_addr' on a pooled session; raises if
+        delivery fails. Run it through submit(), which keeps the account
+        within its concurrency limit.
+
+        A reused session the server dropped is retried once on a fresh one,
+        but only if the drop came before DATA: after that the server may
+        have accepted the message, and a retry could deliver it twice.
+        """
+        entry = self._entry(email_addr, password)
+        while True:
+            smtp, sent = self._checkout(email_addr, password, entry)
+            smtp.in_data = False
+            try:
+                smtp.sendmail(email_addr, recipients, message)
+            except smtplib.SMTPServerDisconnected:
+                self._close_all([(smtp, 0, 0)])
+                if sent and not smtp.in_data:
+                    logger.info(f"{email_addr}: pooled SMTP session dropped, reconnecting")
+                    continue
+                raise
+            except Exception:
+                self._close_all([(smtp, 0, 0)])
+                raise
+            self._checkin(smtp, sent + 1, entry)
+            return
+
+    # -----------------------------
+    # Dispatch
+    # -----------------------------
+    def submit(self, email_addr, fn, *args, **kwargs) -> Future:
+        """
+        Run a delivery for sender 'email_addr' on the SMTP workers; returns
+        its Future. Beyond PER_ACCOUNT in flight for that sender, it waits
+        in the sender's queue without holding a worker.
+        """
+        key = email_addr.lower()
+        job = (Future(), fn, args, kwargs)
+        with self._lock:
+            queue = self._queues.setdefault(key, _SendQueue())
+            if queue.in_flight >= PER_ACCOUNT:
+                queue.waiting.append(job)
+                return job[0]
+            queue.in_flight += 1
+        self._start(key, job)
+        return job[0]
+
+    def _start(self, key, job):
+        future = job[0]
+        if not future.set_running_or_notify_cancel():
+            self._finish(key)  # Cancelled while waiting: pass the slot on
+            return
+        self._workers.submit(self._run, key, job)
+
+    def _run(self, key, job):
+        future, fn, args, kwargs = job
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            self._finish(key)
+
+    def _finish(self, key):
+        # The finished job's slot goes to the sender's next waiting job
+        with self._lock:
+            queue = self._queues[key]
+            if not queue.waiting:
+                queue.in_flight -= 1
+                return
+            job = queue.waiting.popleft()
+        self._start(key, job)
+
+    @staticmethod
+    def _close_all(sessions):
+        for smtp, _, _ in sessions:
+            try:
+                smtp.quit()
+            except Exception:
+                try:
+                    smtp.close()
+                except Exception:
+                    pass
+
+
+POOL = SmtpPool()
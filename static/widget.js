@@ -20,7 +20,12 @@ document.addEventListener('DOMContentLoaded', () => {
     // State
     // -----------------------------
     let socket = null;
-    let lastCount = 0;
+    // Server messages shown, oldest first. /api/sync returns the newest page;
+    // older pages are fetched with its next_before cursor on scroll-up.
+    let history = [];
+    let seenIds = new Set();
+    let olderCursor = null;
+    let loadingOlder = false;
 
     // -----------------------------
     // UI actions
@@ -105,6 +110,19 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    function renderHistory() {
+        messagesArea.innerHTML = "";
+        history.forEach(m =>
+            addMessage(m.text, m.sender === "admin" ? "admin" : "visitor")
+        );
+    }
+
+    function resetHistory() {
+        history = [];
+        seenIds = new Set();
+        olderCursor = null;
+    }
+
     // -----------------------------
     // Polling fallback (EMAIL ONLY)
     // -----------------------------
@@ -117,25 +135,59 @@ document.addEventListener('DOMContentLoaded', () => {
             const data = await res.json();
             const msgs = data.messages || [];
 
-            if (msgs.length !== lastCount) {
-                messagesArea.innerHTML = "";
-                msgs.forEach(m =>
-                    addMessage(m.text, m.sender === "admin" ? "admin" : "visitor")
-                );
-                lastCount = msgs.length;
+            const fresh = msgs.filter(m => !seenIds.has(m.id));
+            if (!fresh.length) return;
+
+            // More new messages than one page: older ones are reached by paging
+            if (fresh.length === msgs.length) {
+                resetHistory();
+                olderCursor = data.next_before || null;
             }
+            fresh.forEach(m => {
+                history.push(m);
+                seenIds.add(m.id);
+            });
+            renderHistory();
         } catch (err) {
             console.error("poll error", err);
         }
     }
 
+    async function loadOlder() {
+        const email = emailInput.value.trim();
+        if (!email || !olderCursor || loadingOlder) return;
+
+        loadingOlder = true;
+        try {
+            const res = await fetch(`/api/sync?email=${encodeURIComponent(email)}&before=${encodeURIComponent(olderCursor)}`);
+            const data = await res.json();
+            const older = (data.messages || []).filter(m => !seenIds.has(m.id));
+            older.forEach(m => seenIds.add(m.id));
+            history = older.concat(history);
+            olderCursor = data.next_before || null;
+
+            // Keep the visitor's place instead of jumping to the bottom
+            const fromBottom = messagesArea.scrollHeight - messagesArea.scrollTop;
+            renderHistory();
+            messagesArea.scrollTop = messagesArea.scrollHeight - fromBottom;
+        } catch (err) {
+            console.error("history error", err);
+        } finally {
+            loadingOlder = false;
+        }
+    }
+
+    messagesArea.addEventListener("scroll", () => {
+        if (messagesArea.scrollTop === 0) loadOlder();
+    });
+
     // -----------------------------
     // 🔁 VERY IMPORTANT UX FIX
     // Reset chat when email changes
     // -----------------------------
     emailInput.addEventListener("change", () => {
         messagesArea.innerHTML = "";
-        lastCount = 0;
+        resetHistory();
 
         if (socket) {
             socket.close();
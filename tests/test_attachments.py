@@ -0,0 +1,72 @@
+"""
+store_attachment() under concurrency. Needs a MongoDB at MONGO_URI; the
+test always uses its own database (mini_crisp_test) and drops it.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pymongo = pytest.importorskip("pymongo")
+
+# Never the configured MONGO_DB: the fixture below wipes the database
+os.environ["MONGO_DB"] = "mini_crisp_test"
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017")
+
+try:
+    pymongo.MongoClient(MONGO_URI, serverSelectionTimeoutMS=1000).admin.command("ping")
+except pymongo.errors.PyMongoError:
+    pytest.skip("MongoDB not reachable", allow_module_level=True)
+
+import database  # noqa: E402  (needs the server check above)
+
+if not database.DB_NAME.endswith("_test"):
+    # database was imported earlier with another MONGO_DB
+    pytest.skip(f"refusing to run against {database.DB_NAME}", allow_module_level=True)
+
+
+@pytest.fixture(autouse=True)
+def clean_gridfs():
+    database.fs_files.delete_many({})
+    database.fs_chunks.delete_many({})
+    yield
+    database.client.drop_database(database.DB_NAME)
+
+
+class _RacingFiles:
+    """
+    fs_files stand-in whose first lookup in each thread misses, after both
+    threads have looked: both then race to fs.put the same bytes.
+    """
+
+    def __init__(self, files, parties):
+        self._files = files
+        self._barrier = threading.Barrier(parties)
+        self._seen = threading.local()
+
+    def find_one_and_update(self, *args, **kwargs):
+        if not getattr(self._seen, "done", False):
+            self._seen.done = True
+            self._barrier.wait(timeout=10)
+            return None
+        return self._files.find_one_and_update(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._files, name)
+
+
+def test_concurrent_store_of_same_bytes_shares_one_file(monkeypatch):
+    monkeypatch.setattr(database, "fs_files", _RacingFiles(database.fs_files, 2))
+    content = os.urandom(600 * 1024)  # several chunks
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        ids = list(pool.map(lambda _: database.store_attachment(content, "a.bin", "application/octet-stream"), range(2)))
+
+    assert ids[0] == ids[1]
+    files = list(database.client[database.DB_NAME]["fs.files"].find({}))
+    assert len(files) == 1
+    assert files[0]["refcount"] == 2
+    # The loser's chunks are gone; only the winner's remain
+    assert database.fs_chunks.distinct("files_id") == [ids[0]]
+    assert database.fs.get(ids[0]).read() == content
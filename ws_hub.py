@@ -0,0 +1,157 @@
+# ws_hub.py
+"""
+WebSocket fan-out.
+
+Each socket gets a bounded send queue drained by its own writer task, so a
+slow client only ever delays itself. Payloads are serialized once per
+broadcast. A client whose queue overflows loses the frame and is
+disconnected; admin dashboards resume from their last seq on reconnect.
+"""
+import asyncio
+import json
+import logging
+
+from fastapi import WebSocket
+
+logger = logging.getLogger("ws_hub")
+
+MAX_QUEUE = 256
+SLOW_CLIENT_CLOSE_CODE = 1013  # "Try again later"
+# How long a direct reply (e.g. a resume) may wait for queue room
+SEND_TIMEOUT = 10
+
+
+def _dumps(payload) -> str:
+    # Same encoding as WebSocket.send_json
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+
+class SocketChannel:
+    """One connected socket: a bounded queue plus the task that drains it."""
+
+    def __init__(self, ws: WebSocket, hub: "FanoutHub", max_queue: int = MAX_QUEUE):
+        self.ws = ws
+        self.hub = hub
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.closed = False
+        self.task = asyncio.create_task(self._writer())
+
+    async def _writer(self):
+        try:
+            while True:
+                text = await self.queue.get()
+                await self.ws.send_text(text)
+                self.hub.stats["frames_sent"] += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # Peer went away; the receive loop will unregister us
+            pass
+        finally:
+            self.closed = True
+
+    def offer(self, text: str) -> bool:
+        """Enqueue without waiting. False if the client is gone or too slow."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(text)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def send(self, payload, timeout: float = SEND_TIMEOUT) -> bool:
+        """
+        Enqueue, waiting up to 'timeout' for room (backpressure on the caller
+        only). A client that does not drain in time, or whose writer has
+        died, is closed; returns False then.
+        """
+        if self.closed:
+            return False
+        try:
+            await asyncio.wait_for(self.queue.put(_dumps(payload)), timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.hub.stats["slow_disconnects"] += 1
+            logger.warning("Dropping slow websocket client (send timed out)")
+            await self.close(SLOW_CLIENT_CLOSE_CODE)
+            return False
+
+    async def close(self, code: int = 1000):
+        self.closed = True
+        self.task.cancel()
+        try:
+            await self.ws.close(code=code)
+        except Exception:
+            pass
+
+
+class FanoutHub:
+    """Registry of visitor and admin sockets with non-blocking broadcast."""
+
+    def __init__(self, max_queue: int = MAX_QUEUE):
+        self.max_queue = max_queue
+        self.visitors: dict[str, set[SocketChannel]] = {}
+        self.admins: set[SocketChannel] = set()
+        self.stats = {"frames_sent": 0, "dropped_frames": 0, "slow_disconnects": 0}
+
+    # -----------------------------
+    # Registration
+    # -----------------------------
+    def add_visitor(self, key: str, ws: WebSocket) -> SocketChannel:
+        channel = SocketChannel(ws, self, self.max_queue)
+        self.visitors.setdefault(key, set()).add(channel)
+        return channel
+
+    def remove_visitor(self, key: str, channel: SocketChannel):
+        channels = self.visitors.get(key)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                self.visitors.pop(key, None)
+        channel.task.cancel()
+
+    def add_admin(self, ws: WebSocket) -> SocketChannel:
+        channel = SocketChannel(ws, self, self.max_queue)
+        self.admins.add(channel)
+        return channel
+
+    def remove_admin(self, channel: SocketChannel):
+        self.admins.discard(channel)
+        channel.task.cancel()
+
+    # -----------------------------
+    # Broadcast
+    # -----------------------------
+    def publish_to_admins(self, payload):
+        self._publish(list(self.admins), payload)
+
+    def publish_to_visitor(self, key: str, payload):
+        self._publish(list(self.visitors.get(key, ())), payload)
+
+    def _publish(self, channels, payload):
+        if not channels:
+            return
+        text = _dumps(payload)
+        for channel in channels:
+            if channel.offer(text):
+                continue
+            self.stats["dropped_frames"] += 1
+            if not channel.closed:
+                # Queue overflowed: cut the slow client loose
+                self.stats["slow_disconnects"] += 1
+                logger.warning("Dropping slow websocket client (queue full)")
+                asyncio.create_task(channel.close(SLOW_CLIENT_CLOSE_CODE))
+
+    def snapshot(self) -> dict:
+        """Counters for the admin stats endpoint."""
+        channels = list(self.admins) + [c for cs in self.visitors.values() for c in cs]
+        depths = [c.queue.qsize() for c in channels]
+        return {
+            **self.stats,
+            "admin_connections": len(self.admins),
+            "visitor_connections": len(channels) - len(self.admins),
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "queue_limit": self.max_queue
+        }